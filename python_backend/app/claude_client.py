@@ -1,5 +1,7 @@
 import os
 import json
+import time
+import uuid
 import boto3
 from dotenv import load_dotenv
 import re
@@ -7,8 +9,22 @@ import re
 # Load environment variables from .env.aws file
 load_dotenv(dotenv_path='../.env.aws')
 
+SYSTEM_PROMPT = "使用与用户相同的语言回复，除非明确指定创作或者生成，否则拒绝虚构内容，回答问题时，关键观点与事实，请引用原文！"
+
+# Maximum number of tool-use round trips in one user turn
+MAX_TOOL_ROUNDS = 5
+
+# Added to the system prompt on the round after the last tool round
+FINAL_ROUND_PROMPT = "工具调用次数已达上限，本轮不能再调用任何工具，请直接根据已有信息完成回答。"
+
+# Appended to the reply when the model still asks for a tool on that round
+TOOL_LIMIT_NOTICE = "（已达到工具调用次数上限，回答可能不完整。）"
+
+# Default output token limit per Bedrock call
+MAX_TOKENS = 4096
+
 class ClaudeClient:
-    def __init__(self):
+    def __init__(self, tool_registry=None, usage_ledger=None):
         # Create Bedrock Runtime client
         self.bedrock_runtime = boto3.client(
             'bedrock-runtime',
@@ -16,143 +32,195 @@ class ClaudeClient:
             aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
             aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
         )
+        # Tools Claude may call; None disables tool use
+        self.tool_registry = tool_registry
+        # Records token usage and enforces budgets; None disables accounting
+        self.usage_ledger = usage_ledger
     
-    async def send_message(self, model_id, messages, enable_reasoning=False):
+    async def send_message(self, model_id, messages, enable_reasoning=False, context=None, session_id=None):
         """
         Send a message to Claude and get a response
         """
         try:
-            # Format messages for Claude
-            formatted_messages = [
-                {
-                    "role": msg["role"],
-                    "content": [{"type": "text", "text": msg["content"]}]
-                }
-                for msg in messages
-            ]
-            
-            # Create request parameters
-            params = {
-                "modelId": model_id,
-                "contentType": "application/json",
-                "accept": "application/json",
-                "body": json.dumps({
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 4096,
-                    "messages": formatted_messages,
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "system": "使用与用户相同的语言回复，除非明确指定创作或者生成，否则拒绝虚构内容，回答问题时，关键观点与事实，请引用原文！"
-                })
-            }
-            
-            # Call Claude API
-            response = self.bedrock_runtime.invoke_model(**params)
+            formatted_messages = self._format_messages(messages)
+            turn_id = f"turn_{uuid.uuid4().hex}"
+            usage = {}
+            text_parts = []
+            tool_trace = []
             
-            # Parse response
-            response_body = json.loads(response["body"].read().decode())
+            for round_number in range(1, MAX_TOOL_ROUNDS + 2):
+                # Call Claude API
+                final_round = round_number > MAX_TOOL_ROUNDS
+                params, reservation = await self._prepare_call(model_id, formatted_messages, context, session_id,
+                                                               final_round)
+                try:
+                    response = self.bedrock_runtime.invoke_model(**params)
+                    
+                    # Parse response
+                    response_body = json.loads(response["body"].read().decode())
+                    await self._record_usage(session_id, model_id, response_body.get("usage", {}), usage,
+                                             reservation, turn_id, round_number)
+                finally:
+                    self._release(reservation)
+                
+                content = response_body.get("content", [])
+                text_parts.extend(block["text"] for block in content if block.get("type") == "text" and block["text"])
+                tool_uses = [block for block in content if block.get("type") == "tool_use"]
+                
+                if response_body.get("stop_reason") != "tool_use" or not tool_uses:
+                    break
+                if final_round:
+                    text_parts.append(TOOL_LIMIT_NOTICE)
+                    break
+                
+                # Run the requested tools and send their results back
+                tool_results, trace = await self._run_tools(round_number, tool_uses)
+                tool_trace.append(trace)
+                formatted_messages.append({"role": "assistant", "content": content})
+                formatted_messages.append({"role": "user", "content": tool_results})
             
             # Extract content
-            response_text = ""
+            response_text = "\n\n".join(text_parts)
             reasoning_text = ""
             
-            if response_body.get("content") and len(response_body["content"]) > 0:
-                response_text = response_body["content"][0]["text"]
-                
-                # If reasoning is enabled, try to extract reasoning and response parts
-                if enable_reasoning:
-                    parts = self._extract_reasoning_and_response(response_text)
-                    reasoning_text = parts["reasoning"]
-                    response_text = parts["response"]
+            # If reasoning is enabled, try to extract reasoning and response parts
+            if response_text and enable_reasoning:
+                parts = self._extract_reasoning_and_response(response_text)
+                reasoning_text = parts["reasoning"]
+                response_text = parts["response"]
             
             return {
                 "response": response_text,
                 "reasoning": reasoning_text,
-                "usage": response_body.get("usage", {})
+                "usage": usage,
+                "turnId": turn_id,
+                "toolTrace": tool_trace
             }
         except Exception as error:
             print(f"Error calling Claude API: {error}")
             raise error
     
-    async def stream_message(self, model_id, messages, enable_reasoning=False):
+    async def stream_message(self, model_id, messages, enable_reasoning=False, context=None, session_id=None):
         """
         Stream a message to Claude and get a response in chunks
         """
         try:
-            # Format messages for Claude
-            formatted_messages = [
-                {
-                    "role": msg["role"],
-                    "content": [{"type": "text", "text": msg["content"]}]
-                }
-                for msg in messages
-            ]
+            formatted_messages = self._format_messages(messages)
+            turn_id = f"turn_{uuid.uuid4().hex}"
+            usage = {}
             
-            # Create request parameters
-            params = {
-                "modelId": model_id,
-                "contentType": "application/json",
-                "accept": "application/json",
-                "body": json.dumps({
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 4096,
-                    "messages": formatted_messages,
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "system": "使用与用户相同的语言回复，除非明确指定创作或者生成，否则拒绝虚构内容，回答问题时，关键观点与事实，请引用原文！"
-                })
+            state = {
+                "full_response": "",
+                "is_thinking": enable_reasoning,
+                "response_text": ""
             }
             
-            # Call Claude API with streaming
-            response = self.bedrock_runtime.invoke_model_with_response_stream(**params)
-            
-            full_response = ""
-            is_thinking = enable_reasoning
-            thinking_text = ""
-            response_text = ""
-            
-            # Process each chunk
-            for event in response["body"]:
-                if "chunk" in event:
-                    # Parse chunk
-                    chunk_data = json.loads(event["chunk"]["bytes"].decode())
-                    
-                    if (chunk_data.get("type") == "content_block_delta" and 
-                        chunk_data.get("delta", {}).get("type") == "text_delta"):
+            for round_number in range(1, MAX_TOOL_ROUNDS + 2):
+                # Call Claude API with streaming
+                final_round = round_number > MAX_TOOL_ROUNDS
+                params, reservation = await self._prepare_call(model_id, formatted_messages, context, session_id,
+                                                               final_round)
+                
+                # Content blocks of this assistant turn, by index
+                blocks = {}
+                stop_reason = None
+                round_usage = {}
+                
+                try:
+                    response = self.bedrock_runtime.invoke_model_with_response_stream(**params)
+                
+                    # Process each chunk
+                    for event in response["body"]:
+                        if "chunk" not in event:
+                            continue
+                        
+                        # Parse chunk
+                        chunk_data = json.loads(event["chunk"]["bytes"].decode())
+                        chunk_type = chunk_data.get("type")
                         
-                        text_chunk = chunk_data["delta"]["text"]
-                        full_response += text_chunk
+                        if chunk_type == "message_start":
+                            # Input tokens are reported when the message starts
+                            round_usage.update(chunk_data.get("message", {}).get("usage", {}))
                         
-                        # If reasoning is enabled, try to determine if we're in thinking or response mode
-                        if enable_reasoning:
-                            if is_thinking:
-                                # Check if we've reached the end of thinking section
-                                if any(marker in full_response for marker in [
-                                    'Final Answer:', 'Final Response:', 'My answer:', 'My response:'
-                                ]):
-                                    is_thinking = False
-                                    
-                                    # Extract thinking part
-                                    parts = self._extract_reasoning_and_response(full_response)
-                                    thinking_text = parts["reasoning"]
-                                    response_text = parts["response"]
-                                    
-                                    # Yield thinking and initial response
-                                    yield {"type": "thinking", "content": thinking_text}
-                                    yield {"type": "content", "content": response_text}
-                                else:
-                                    # Still in thinking mode
-                                    yield {"type": "thinking", "content": text_chunk}
+                        elif chunk_type == "content_block_start":
+                            block = chunk_data.get("content_block", {})
+                            if block.get("type") == "tool_use":
+                                blocks[chunk_data["index"]] = {
+                                    "type": "tool_use", "id": block["id"], "name": block["name"], "input_json": ""
+                                }
                             else:
-                                # In response mode
-                                response_text += text_chunk
-                                yield {"type": "content", "content": text_chunk}
-                        else:
-                            # No reasoning, just send content
-                            yield {"type": "content", "content": text_chunk}
+                                blocks[chunk_data["index"]] = {"type": "text", "text": ""}
+                        
+                        elif chunk_type == "content_block_delta":
+                            delta = chunk_data.get("delta", {})
+                            block = blocks.setdefault(chunk_data.get("index", 0), {"type": "text", "text": ""})
+                        
+                            if delta.get("type") == "text_delta":
+                                block["text"] += delta["text"]
+                                for output in self._route_text(state, delta["text"], enable_reasoning):
+                                    yield output
+                            elif delta.get("type") == "input_json_delta":
+                                # Tool input arrives as partial JSON fragments
+                                block["input_json"] += delta.get("partial_json", "")
+                        
+                        elif chunk_type == "message_delta":
+                            stop_reason = chunk_data.get("delta", {}).get("stop_reason")
+                            # Cumulative output tokens for the message
+                            round_usage.update(chunk_data.get("usage", {}))
+                        
+                        elif chunk_type == "message_stop" and not round_usage:
+                            # Fall back to Bedrock's invocation metrics
+                            metrics = chunk_data.get("amazon-bedrock-invocationMetrics", {})
+                            round_usage = {
+                                "input_tokens": metrics.get("inputTokenCount", 0),
+                                "output_tokens": metrics.get("outputTokenCount", 0)
+                            }
+                finally:
+                    # Bedrock bills the tokens it has reported even if the stream failed or the
+                    # client went away, so record them before returning the rest of the reservation
+                    try:
+                        if round_usage:
+                            await self._record_usage(session_id, model_id, round_usage, usage,
+                                                     reservation, turn_id, round_number)
+                    finally:
+                        self._release(reservation)
+                
+                tool_uses = [
+                    {"type": "tool_use", "id": block["id"], "name": block["name"],
+                     "input": json.loads(block["input_json"]) if block["input_json"] else {}}
+                    for _, block in sorted(blocks.items()) if block["type"] == "tool_use"
+                ]
+                if stop_reason != "tool_use" or not tool_uses:
+                    break
+                if final_round:
+                    separator = "\n\n" if state["full_response"].strip() else ""
+                    for output in self._route_text(state, separator + TOOL_LIMIT_NOTICE, enable_reasoning):
+                        yield output
+                    break
+                
+                for tool_use in tool_uses:
+                    yield {"type": "tool_use", "id": tool_use["id"], "name": tool_use["name"], "input": tool_use["input"]}
+                
+                # Run the requested tools, send their results back and keep streaming
+                tool_results, trace = await self._run_tools(round_number, tool_uses)
+                yield {"type": "tool_result", "trace": trace}
+                
+                assistant_content = [
+                    {"type": "text", "text": block["text"]}
+                    for _, block in sorted(blocks.items()) if block["type"] == "text" and block["text"]
+                ] + tool_uses
+                formatted_messages.append({"role": "assistant", "content": assistant_content})
+                formatted_messages.append({"role": "user", "content": tool_results})
+                
+                # Separate text written before and after the tool calls
+                if state["full_response"].strip():
+                    for output in self._route_text(state, "\n\n", enable_reasoning):
+                        yield output
+            
+            full_response = state["full_response"]
             
             # If we're still in thinking mode at the end, try to extract reasoning and response
-            if enable_reasoning and is_thinking:
+            if enable_reasoning and state["is_thinking"]:
                 parts = self._extract_reasoning_and_response(full_response)
                 if parts["reasoning"] and parts["response"]:
                     yield {"type": "thinking", "content": parts["reasoning"]}
@@ -160,12 +228,139 @@ class ClaudeClient:
                     full_response = parts["response"]
             
             # Signal completion
-            yield {"type": "done", "content": full_response}
+            yield {"type": "done", "content": full_response, "usage": usage, "turnId": turn_id}
             
         except Exception as error:
             print(f"Error setting up streaming: {error}")
             yield {"type": "error", "error": str(error)}
     
+    async def check_budget(self, model_id, messages, context=None, session_id=None):
+        """
+        Raise TokenBudgetExceeded if the first call for these messages would not
+        fit the token budgets, so a message can be refused before it is stored
+        """
+        if self.usage_ledger is None:
+            return
+        _, reservation = await self._prepare_call(model_id, self._format_messages(messages), context, session_id)
+        self._release(reservation)
+    
+    def _route_text(self, state, text_chunk, enable_reasoning):
+        """
+        Route a streamed text chunk to thinking or content output
+        """
+        state["full_response"] += text_chunk
+        
+        # If reasoning is enabled, try to determine if we're in thinking or response mode
+        if enable_reasoning:
+            if state["is_thinking"]:
+                # Check if we've reached the end of thinking section
+                if any(marker in state["full_response"] for marker in [
+                    'Final Answer:', 'Final Response:', 'My answer:', 'My response:'
+                ]):
+                    state["is_thinking"] = False
+                    
+                    # Extract thinking part
+                    parts = self._extract_reasoning_and_response(state["full_response"])
+                    state["response_text"] = parts["response"]
+                    
+                    # Yield thinking and initial response
+                    yield {"type": "thinking", "content": parts["reasoning"]}
+                    yield {"type": "content", "content": parts["response"]}
+                else:
+                    # Still in thinking mode
+                    yield {"type": "thinking", "content": text_chunk}
+            else:
+                # In response mode
+                state["response_text"] += text_chunk
+                yield {"type": "content", "content": text_chunk}
+        else:
+            # No reasoning, just send content
+            yield {"type": "content", "content": text_chunk}
+    
+    async def _prepare_call(self, model_id, formatted_messages, context, session_id, final_round=False):
+        """
+        Build request parameters after reserving tokens against the budgets,
+        lowering max_tokens when little budget is left
+        """
+        params = self._build_params(model_id, formatted_messages, context, final_round=final_round)
+        if self.usage_ledger is None:
+            return params, None
+        
+        estimated_input_tokens = self.usage_ledger.estimate_tokens(params["body"])
+        reservation = await self.usage_ledger.reserve(session_id, estimated_input_tokens, MAX_TOKENS)
+        if reservation["maxTokens"] < MAX_TOKENS:
+            params = self._build_params(model_id, formatted_messages, context, reservation["maxTokens"], final_round)
+        return params, reservation
+    
+    async def _record_usage(self, session_id, model_id, call_usage, usage, reservation=None,
+                            turn_id=None, round_number=1):
+        """
+        Add one call's usage to the turn totals and the usage ledger
+        """
+        for key, value in call_usage.items():
+            if isinstance(value, int):
+                usage[key] = usage.get(key, 0) + value
+        if self.usage_ledger is not None:
+            await self.usage_ledger.record(session_id, model_id, call_usage, reservation, turn_id, round_number)
+    
+    def _release(self, reservation):
+        if self.usage_ledger is not None:
+            self.usage_ledger.release(reservation)
+    
+    async def _run_tools(self, round_number, tool_uses):
+        """
+        Execute one round of tool calls concurrently and trace their latency
+        """
+        start_time = time.perf_counter()
+        tool_results, calls = await self.tool_registry.execute_all(tool_uses)
+        trace = {
+            "round": round_number,
+            "latencyMs": round((time.perf_counter() - start_time) * 1000, 3),
+            "calls": calls
+        }
+        print(f"Tool round {round_number}: {len(calls)} call(s) in {trace['latencyMs']} ms - "
+              + ", ".join(f"{call['name']} {call['latencyMs']} ms" for call in calls))
+        return tool_results, trace
+    
+    def _format_messages(self, messages):
+        """
+        Format messages for Claude, keeping content that is already a list of blocks
+        """
+        return [
+            {
+                "role": msg["role"],
+                "content": msg["content"] if isinstance(msg["content"], list)
+                else [{"type": "text", "text": msg["content"]}]
+            }
+            for msg in messages
+        ]
+    
+    def _build_params(self, model_id, formatted_messages, context=None, max_tokens=MAX_TOKENS, final_round=False):
+        """
+        Create request parameters, appending retrieved reference passages to the system prompt.
+        Tool definitions stay in the final round because earlier tool_use blocks require them,
+        but the system prompt tells the model no more tools may be called.
+        """
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "messages": formatted_messages,
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "system": f"{SYSTEM_PROMPT}\n\n{context}" if context else SYSTEM_PROMPT
+        }
+        if self.tool_registry is not None and len(self.tool_registry) > 0:
+            body["tools"] = self.tool_registry.definitions()
+        if final_round:
+            body["system"] += f"\n\n{FINAL_ROUND_PROMPT}"
+        
+        return {
+            "modelId": model_id,
+            "contentType": "application/json",
+            "accept": "application/json",
+            "body": json.dumps(body)
+        }
+    
     def _extract_reasoning_and_response(self, text):
         """
         Extract reasoning and response parts from Claude's output
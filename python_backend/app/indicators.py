@@ -0,0 +1,481 @@
+import numpy as np
+
+from app.market_data import price_store
+
+# Tool definition exposed to Claude (Anthropic tool-use schema)
+INDICATOR_TOOL = {
+    "name": "technical_indicators",
+    "description": (
+        "获取资产的最新技术指标摘要，包括SMA、EMA、RSI、MACD、布林带和ATR。"
+        "数据来自本地行情数据和实时报价。"
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "symbols": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "资产代码列表，例如 [\"BTC-USD\", \"AAPL\"]"
+            }
+        },
+        "required": ["symbols"]
+    }
+}
+
+# Largest factor (1 - alpha) ** -i allowed inside one closed-form smoothing block
+_MAX_GROWTH = 1e200
+
+
+def _exponential(seed, values, alpha):
+    """
+    Evaluate y[i] = (1 - alpha) * y[i - 1] + alpha * values[i] with y[-1] = seed.
+
+    Uses the closed form y[i] = r^(i+1) * (seed + alpha * sum_j values[j] * r^-(j+1))
+    with r = 1 - alpha, in blocks short enough that r^-i cannot overflow.
+    """
+    decay = 1.0 - alpha
+    out = np.empty(values.size, dtype=np.float64)
+    if decay <= 0.0:
+        out[:] = values
+        return out
+
+    block = max(1, int(np.log(_MAX_GROWTH) / -np.log(decay)))
+    powers = decay ** np.arange(1, min(block, values.size) + 1)
+    for start in range(0, values.size, block):
+        chunk = values[start:start + block]
+        scale = powers[:chunk.size]
+        out[start:start + chunk.size] = scale * (seed + alpha * np.cumsum(chunk / scale))
+        seed = out[start + chunk.size - 1]
+    return out
+
+
+def _smooth(values, period, alpha):
+    """Running mean for the first `period` values, exponential smoothing afterwards"""
+    values = np.asarray(values, dtype=np.float64)
+    out = np.empty(values.size, dtype=np.float64)
+    head = min(period, values.size)
+    out[:head] = np.cumsum(values[:head]) / np.arange(1, head + 1)
+    if values.size > period:
+        out[period:] = _exponential(out[period - 1], values[period:], alpha)
+    return out
+
+
+def _true_range(highs, lows, closes):
+    ranges = highs - lows
+    if closes.size > 1:
+        previous = closes[:-1]
+        ranges[1:] = np.maximum.reduce([
+            ranges[1:], np.abs(highs[1:] - previous), np.abs(lows[1:] - previous)
+        ])
+    return ranges
+
+
+def sma(closes, period):
+    """Simple moving average; NaN until `period` values are available"""
+    closes = np.asarray(closes, dtype=np.float64)
+    out = np.full(closes.size, np.nan)
+    if closes.size >= period:
+        sums = np.cumsum(closes)
+        out[period - 1] = sums[period - 1]
+        out[period:] = sums[period:] - sums[:-period]
+        out[period - 1:] /= period
+    return out
+
+
+def ema(closes, period):
+    """Exponential moving average seeded with the SMA of the first `period` values"""
+    out = _smooth(closes, period, 2.0 / (period + 1))
+    out[:period - 1] = np.nan
+    return out
+
+
+def rsi(closes, period=14):
+    """Wilder's relative strength index"""
+    closes = np.asarray(closes, dtype=np.float64)
+    out = np.full(closes.size, np.nan)
+    if closes.size > period:
+        changes = np.diff(closes)
+        average_gain = _smooth(np.maximum(changes, 0.0), period, 1.0 / period)[period - 1:]
+        average_loss = _smooth(np.maximum(-changes, 0.0), period, 1.0 / period)[period - 1:]
+        out[period:] = _relative_strength(average_gain, average_loss)
+    return out
+
+
+def _relative_strength(average_gain, average_loss):
+    total = average_gain + average_loss
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, 100.0 * average_gain / total, 50.0)
+
+
+def macd(closes, fast=12, slow=26, signal=9):
+    """MACD line, signal line and histogram"""
+    closes = np.asarray(closes, dtype=np.float64)
+    line = ema(closes, fast) - ema(closes, slow)
+    signal_line = np.full(closes.size, np.nan)
+    if closes.size >= slow:
+        signal_line[slow - 1:] = ema(line[slow - 1:], signal)
+    return line, signal_line, line - signal_line
+
+
+def bollinger_bands(closes, period=20, width=2.0):
+    """Middle, upper and lower Bollinger bands using the population standard deviation"""
+    closes = np.asarray(closes, dtype=np.float64)
+    middle = sma(closes, period)
+    deviation = np.full(closes.size, np.nan)
+    if closes.size >= period:
+        windows = np.lib.stride_tricks.sliding_window_view(closes, period)
+        deviation[period - 1:] = windows.std(axis=1)
+    return middle, middle + width * deviation, middle - width * deviation
+
+
+def atr(highs, lows, closes, period=14):
+    """Wilder's average true range"""
+    closes = np.asarray(closes, dtype=np.float64)
+    highs = closes if highs is None else np.asarray(highs, dtype=np.float64)
+    lows = closes if lows is None else np.asarray(lows, dtype=np.float64)
+    out = _smooth(_true_range(highs, lows, closes), period, 1.0 / period)
+    out[:period - 1] = np.nan
+    return out
+
+
+class IndicatorEngine:
+    """
+    Streaming indicators for many symbols.
+
+    Each symbol owns one slot in a set of NumPy arrays (struct of arrays) and
+    its recent closes live in one row of a 2-D ring buffer. Every update is
+    O(1) per symbol and a batch of ticks for different symbols is applied
+    with a fixed number of vectorized operations.
+    """
+
+    _FIELDS = (
+        "anchor", "last", "sma_sum", "band_sum", "band_sum_sq", "ema",
+        "ema_fast", "ema_slow", "signal", "average_gain", "average_loss", "atr"
+    )
+
+    def __init__(self, sma_period=20, ema_period=20, rsi_period=14, macd_periods=(12, 26, 9),
+                 bollinger_period=20, bollinger_width=2.0, atr_period=14,
+                 history=256, initial_symbols=64, store=None):
+        self.store = store or price_store
+        self.sma_period = sma_period
+        self.ema_period = ema_period
+        self.rsi_period = rsi_period
+        self.macd_fast, self.macd_slow, self.macd_signal = macd_periods
+        self.bollinger_period = bollinger_period
+        self.bollinger_width = bollinger_width
+        self.atr_period = atr_period
+        self.history = max(history, sma_period, bollinger_period)
+
+        self._slots = {}
+        self._capacity = initial_symbols
+        self.count = np.zeros(initial_symbols, dtype=np.int64)
+        self.closes = np.zeros((initial_symbols, self.history), dtype=np.float64)
+        for field in self._FIELDS:
+            setattr(self, field, np.zeros(initial_symbols, dtype=np.float64))
+
+    def get_symbols(self):
+        """List all tracked symbols"""
+        return sorted(self._slots)
+
+    def is_tracked(self, symbol):
+        """Check whether a symbol has streaming state"""
+        return symbol in self._slots
+
+    def update(self, symbol, price, high=None, low=None):
+        """Apply a single tick or bar close for one symbol"""
+        price = float(price)
+        high = price if high is None else float(high)
+        low = price if low is None else float(low)
+        if not price > 0 or price == float("inf"):
+            raise ValueError("Prices must be finite and positive")
+        if not (np.isfinite(high) and np.isfinite(low) and low <= price <= high):
+            raise ValueError("Highs and lows must be finite, with low <= price <= high")
+        self._apply_one(self._slot(symbol), price, high, low)
+
+    def update_batch(self, symbols, prices, highs=None, lows=None):
+        """
+        Apply a batch of ticks. Ticks for the same symbol are applied in the
+        order given; ticks for different symbols are applied together.
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        highs = prices if highs is None else np.asarray(highs, dtype=np.float64)
+        lows = prices if lows is None else np.asarray(lows, dtype=np.float64)
+        if not (len(symbols) == prices.size == highs.size == lows.size):
+            raise ValueError("symbols, prices, highs and lows must have the same length")
+        if not np.all(np.isfinite(prices)) or np.any(prices <= 0):
+            raise ValueError("Prices must be finite and positive")
+        if not (np.all(np.isfinite(highs)) and np.all(np.isfinite(lows))
+                and np.all(lows <= prices) and np.all(prices <= highs)):
+            raise ValueError("Highs and lows must be finite, with low <= price <= high")
+
+        # Split repeated symbols into rounds so every round touches distinct slots
+        rounds = []
+        seen = {}
+        for index, symbol in enumerate(symbols):
+            occurrence = seen.get(symbol, 0)
+            seen[symbol] = occurrence + 1
+            if occurrence == len(rounds):
+                rounds.append(([], []))
+            rounds[occurrence][0].append(self._slot(symbol))
+            rounds[occurrence][1].append(index)
+
+        for slots, indices in rounds:
+            self._apply(np.asarray(slots), prices[indices], highs[indices], lows[indices])
+
+    def load_history(self, symbol, closes, highs=None, lows=None):
+        """Replace a symbol's state with indicators computed over a full price history"""
+        closes = np.asarray(closes, dtype=np.float64)
+        if closes.size == 0:
+            raise ValueError(f"No price history for {symbol}")
+        highs = closes if highs is None else np.asarray(highs, dtype=np.float64)
+        lows = closes if lows is None else np.asarray(lows, dtype=np.float64)
+
+        slot = self._slot(symbol)
+        size = closes.size
+        anchor = closes[0]
+        recent = closes[-self.history:]
+        positions = np.arange(size - recent.size, size) % self.history
+
+        self.count[slot] = size
+        self.closes[slot, positions] = recent
+        self.anchor[slot] = anchor
+        self.last[slot] = closes[-1]
+        self.sma_sum[slot] = np.sum(closes[-self.sma_period:] - anchor)
+        band = closes[-self.bollinger_period:] - anchor
+        self.band_sum[slot] = band.sum()
+        self.band_sum_sq[slot] = band @ band
+        self.ema[slot] = _smooth(closes, self.ema_period, 2.0 / (self.ema_period + 1))[-1]
+        fast = _smooth(closes, self.macd_fast, 2.0 / (self.macd_fast + 1))
+        slow = _smooth(closes, self.macd_slow, 2.0 / (self.macd_slow + 1))
+        self.ema_fast[slot] = fast[-1]
+        self.ema_slow[slot] = slow[-1]
+        self.signal[slot] = 0.0
+        self.average_gain[slot] = 0.0
+        self.average_loss[slot] = 0.0
+        if size >= self.macd_slow:
+            line = fast[self.macd_slow - 1:] - slow[self.macd_slow - 1:]
+            self.signal[slot] = _smooth(line, self.macd_signal, 2.0 / (self.macd_signal + 1))[-1]
+        if size > 1:
+            changes = np.diff(closes)
+            self.average_gain[slot] = _smooth(np.maximum(changes, 0.0), self.rsi_period, 1.0 / self.rsi_period)[-1]
+            self.average_loss[slot] = _smooth(np.maximum(-changes, 0.0), self.rsi_period, 1.0 / self.rsi_period)[-1]
+        self.atr[slot] = _smooth(_true_range(highs, lows, closes), self.atr_period, 1.0 / self.atr_period)[-1]
+
+    def get_closes(self, symbol, limit=None):
+        """Get the most recent closes held in the ring buffer, oldest first"""
+        slot = self._slots.get(symbol)
+        if slot is None:
+            return np.empty(0, dtype=np.float64)
+        count = int(self.count[slot])
+        size = min(count, self.history if limit is None else min(limit, self.history))
+        positions = np.arange(count - size, count) % self.history
+        return self.closes[slot, positions]
+
+    def snapshot(self, symbol):
+        """Get the current indicator values for a symbol; None while warming up"""
+        slot = self._slots.get(symbol)
+        if slot is None:
+            return None
+
+        count = int(self.count[slot])
+        anchor = self.anchor[slot]
+        result = {
+            "symbol": symbol,
+            "price": float(self.last[slot]),
+            "count": count,
+            "sma": None,
+            "ema": None,
+            "rsi": None,
+            "macd": None,
+            "bollinger": None,
+            "atr": None
+        }
+        if count >= self.sma_period:
+            result["sma"] = float(anchor + self.sma_sum[slot] / self.sma_period)
+        if count >= self.ema_period:
+            result["ema"] = float(self.ema[slot])
+        if count > self.rsi_period:
+            result["rsi"] = float(_relative_strength(self.average_gain[slot], self.average_loss[slot]))
+        if count >= self.macd_slow:
+            line = float(self.ema_fast[slot] - self.ema_slow[slot])
+            result["macd"] = {"line": line, "signal": None, "histogram": None}
+            if count >= self.macd_slow + self.macd_signal - 1:
+                result["macd"]["signal"] = float(self.signal[slot])
+                result["macd"]["histogram"] = line - float(self.signal[slot])
+        if count >= self.bollinger_period:
+            mean = self.band_sum[slot] / self.bollinger_period
+            deviation = np.sqrt(max(self.band_sum_sq[slot] / self.bollinger_period - mean * mean, 0.0))
+            result["bollinger"] = {
+                "middle": float(anchor + mean),
+                "upper": float(anchor + mean + self.bollinger_width * deviation),
+                "lower": float(anchor + mean - self.bollinger_width * deviation)
+            }
+        if count >= self.atr_period:
+            result["atr"] = float(self.atr[slot])
+        return result
+
+    def summary(self, symbol):
+        """One-line indicator summary suitable for a model prompt"""
+        snapshot = self.snapshot(symbol)
+        if snapshot is None:
+            return f"{symbol}: 无数据"
+
+        parts = [f"{symbol} 最新价 {snapshot['price']:.4g}"]
+        if snapshot["sma"] is not None:
+            parts.append(f"SMA{self.sma_period} {snapshot['sma']:.4g}")
+        if snapshot["ema"] is not None:
+            parts.append(f"EMA{self.ema_period} {snapshot['ema']:.4g}")
+        if snapshot["rsi"] is not None:
+            parts.append(f"RSI{self.rsi_period} {snapshot['rsi']:.1f}")
+        if snapshot["macd"] is not None:
+            macd_values = snapshot["macd"]
+            if macd_values["signal"] is None:
+                parts.append(f"MACD {macd_values['line']:.4g}")
+            else:
+                parts.append(f"MACD {macd_values['line']:.4g}/{macd_values['signal']:.4g}/{macd_values['histogram']:.4g}")
+        if snapshot["bollinger"] is not None:
+            bands = snapshot["bollinger"]
+            parts.append(f"BOLL {bands['lower']:.4g}~{bands['upper']:.4g}")
+        if snapshot["atr"] is not None:
+            parts.append(f"ATR{self.atr_period} {snapshot['atr']:.4g}")
+        parts.append(f"样本 {snapshot['count']}")
+        return " | ".join(parts)
+
+    def _slot(self, symbol):
+        slot = self._slots.get(symbol)
+        if slot is None:
+            slot = len(self._slots)
+            if slot == self._capacity:
+                self._grow()
+            self._slots[symbol] = slot
+        return slot
+
+    def _grow(self):
+        capacity = self._capacity * 2
+        count = np.zeros(capacity, dtype=np.int64)
+        count[:self._capacity] = self.count
+        self.count = count
+        closes = np.zeros((capacity, self.history), dtype=np.float64)
+        closes[:self._capacity] = self.closes
+        self.closes = closes
+        for field in self._FIELDS:
+            values = np.zeros(capacity, dtype=np.float64)
+            values[:self._capacity] = getattr(self, field)
+            setattr(self, field, values)
+        self._capacity = capacity
+
+    @staticmethod
+    def _weight(count, period, alpha):
+        """Running-mean weight until `period` samples, then the smoothing factor"""
+        return np.where(count <= period, 1.0 / np.maximum(count, 1), alpha)
+
+    def _apply(self, slots, prices, highs, lows):
+        count = self.count[slots] + 1
+        first = count == 1
+        previous = np.where(first, prices, self.last[slots])
+        anchor = np.where(first, prices, self.anchor[slots])
+        self.anchor[slots] = anchor
+        deviation = prices - anchor
+
+        # Values leaving the rolling windows are read before the ring slot is overwritten
+        for period, sum_field, squares_field in (
+            (self.sma_period, "sma_sum", None),
+            (self.bollinger_period, "band_sum", "band_sum_sq")
+        ):
+            leaving = self.closes[slots, (count - 1 - period) % self.history] - anchor
+            leaving = np.where(count > period, leaving, 0.0)
+            getattr(self, sum_field)[slots] += deviation - leaving
+            if squares_field is not None:
+                getattr(self, squares_field)[slots] += deviation * deviation - leaving * leaving
+
+        self.closes[slots, (count - 1) % self.history] = prices
+        self.count[slots] = count
+        self.last[slots] = prices
+
+        for period, field in (
+            (self.ema_period, "ema"),
+            (self.macd_fast, "ema_fast"),
+            (self.macd_slow, "ema_slow")
+        ):
+            values = getattr(self, field)
+            values[slots] += (prices - values[slots]) * self._weight(count, period, 2.0 / (period + 1))
+
+        signal_count = count - self.macd_slow + 1
+        ready = signal_count >= 1
+        if np.any(ready):
+            ready_slots = slots[ready]
+            line = self.ema_fast[ready_slots] - self.ema_slow[ready_slots]
+            self.signal[ready_slots] += (line - self.signal[ready_slots]) * self._weight(
+                signal_count[ready], self.macd_signal, 2.0 / (self.macd_signal + 1))
+
+        change = prices - previous
+        change_count = count - 1
+        weight = np.where(first, 0.0, self._weight(change_count, self.rsi_period, 1.0 / self.rsi_period))
+        self.average_gain[slots] += (np.maximum(change, 0.0) - self.average_gain[slots]) * weight
+        self.average_loss[slots] += (np.maximum(-change, 0.0) - self.average_loss[slots]) * weight
+
+        true_range = np.where(
+            first,
+            highs - lows,
+            np.maximum.reduce([highs - lows, np.abs(highs - previous), np.abs(lows - previous)])
+        )
+        self.atr[slots] += (true_range - self.atr[slots]) * self._weight(count, self.atr_period, 1.0 / self.atr_period)
+
+    def _apply_one(self, slot, price, high, low):
+        """Scalar equivalent of _apply, avoiding array overhead for single ticks"""
+        count = int(self.count[slot]) + 1
+        first = count == 1
+        if first:
+            previous = anchor = price
+            self.anchor[slot] = anchor
+        else:
+            previous = float(self.last[slot])
+            anchor = float(self.anchor[slot])
+        deviation = price - anchor
+        row = self.closes[slot]
+
+        leaving = float(row[(count - 1 - self.sma_period) % self.history]) - anchor if count > self.sma_period else 0.0
+        self.sma_sum[slot] += deviation - leaving
+        leaving = float(row[(count - 1 - self.bollinger_period) % self.history]) - anchor if count > self.bollinger_period else 0.0
+        self.band_sum[slot] += deviation - leaving
+        self.band_sum_sq[slot] += deviation * deviation - leaving * leaving
+
+        row[(count - 1) % self.history] = price
+        self.count[slot] = count
+        self.last[slot] = price
+
+        for period, values in ((self.ema_period, self.ema), (self.macd_fast, self.ema_fast),
+                               (self.macd_slow, self.ema_slow)):
+            weight = 1.0 / count if count <= period else 2.0 / (period + 1)
+            values[slot] += (price - values[slot]) * weight
+
+        signal_count = count - self.macd_slow + 1
+        if signal_count >= 1:
+            weight = 1.0 / signal_count if signal_count <= self.macd_signal else 2.0 / (self.macd_signal + 1)
+            line = self.ema_fast[slot] - self.ema_slow[slot]
+            self.signal[slot] += (line - self.signal[slot]) * weight
+
+        if first:
+            true_range = high - low
+        else:
+            change = price - previous
+            weight = 1.0 / min(count - 1, self.rsi_period)
+            self.average_gain[slot] += (max(change, 0.0) - self.average_gain[slot]) * weight
+            self.average_loss[slot] += (max(-change, 0.0) - self.average_loss[slot]) * weight
+            true_range = max(high - low, abs(high - previous), abs(low - previous))
+        self.atr[slot] += (true_range - self.atr[slot]) / min(count, self.atr_period)
+
+    def ensure_loaded(self, symbols):
+        """Seed untracked symbols from the close history in the price store"""
+        for symbol in symbols:
+            if not self.is_tracked(symbol) and self.store.get_length(symbol) > 0:
+                self.load_history(symbol, self.store.get_prices(symbol))
+
+    def run_tool(self, tool_input):
+        """Entry point for the technical_indicators model tool"""
+        self.ensure_loaded(tool_input["symbols"])
+        return "\n".join(self.summary(symbol) for symbol in tool_input["symbols"])
+
+
+# Shared engine used by the API endpoints and model tools
+indicator_engine = IndicatorEngine()
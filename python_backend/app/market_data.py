@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class PriceStore:
+    """In-memory store of close prices per symbol"""
+
+    def __init__(self, initial_capacity=256):
+        self.initial_capacity = initial_capacity
+
+        # symbol -> preallocated float64 buffer and the number of filled slots
+        self._buffers = {}
+        self._lengths = {}
+
+        # Bumped whenever history is dropped so cached statistics can be invalidated
+        self.generation = 0
+
+    def add_prices(self, symbol, prices):
+        """Append one or more close prices to a symbol's history"""
+        values = np.atleast_1d(np.asarray(prices, dtype=np.float64))
+        if values.size == 0:
+            return self.get_length(symbol)
+        if not np.all(np.isfinite(values)) or np.any(values <= 0):
+            raise ValueError(f"Prices for {symbol} must be finite and positive")
+
+        buffer = self._buffers.get(symbol)
+        length = self._lengths.get(symbol, 0)
+        required = length + values.size
+
+        # Grow geometrically so appends stay amortized O(1)
+        if buffer is None or required > buffer.size:
+            capacity = max(self.initial_capacity, buffer.size if buffer is not None else 0)
+            while capacity < required:
+                capacity *= 2
+            grown = np.empty(capacity, dtype=np.float64)
+            if buffer is not None:
+                grown[:length] = buffer[:length]
+            buffer = grown
+            self._buffers[symbol] = buffer
+
+        buffer[length:required] = values
+        self._lengths[symbol] = required
+        return required
+
+    def get_prices(self, symbol):
+        """Get a read-only view of a symbol's close prices"""
+        buffer = self._buffers.get(symbol)
+        if buffer is None:
+            return np.empty(0, dtype=np.float64)
+        view = buffer[:self._lengths[symbol]]
+        view.flags.writeable = False
+        return view
+
+    def get_length(self, symbol):
+        """Get the number of prices stored for a symbol"""
+        return self._lengths.get(symbol, 0)
+
+    def get_symbols(self):
+        """List all symbols with stored prices"""
+        return sorted(self._lengths)
+
+    def get_returns(self, symbols, ends, count):
+        """
+        Get a (count, len(symbols)) matrix of simple returns.
+
+        Row j of column s is the return ending at price index
+        ends[s] - count + j, so series of different lengths are aligned
+        on the caller-supplied end indices.
+        """
+        returns = np.empty((count, len(symbols)), dtype=np.float64)
+        for column, (symbol, end) in enumerate(zip(symbols, ends)):
+            prices = self._buffers[symbol][end - count - 1:end]
+            np.divide(prices[1:], prices[:-1], out=returns[:, column])
+        returns -= 1.0
+        return returns
+
+    def clear(self, symbol=None):
+        """Drop stored prices for one symbol, or for all symbols"""
+        self.generation += 1
+        if symbol is None:
+            self._buffers.clear()
+            self._lengths.clear()
+        else:
+            self._buffers.pop(symbol, None)
+            self._lengths.pop(symbol, None)
+
+
+# Shared store used by the API endpoints and model tools
+price_store = PriceStore()
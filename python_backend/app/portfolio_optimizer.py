@@ -0,0 +1,406 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from app.market_data import price_store
+
+METHODS = ("mean_variance", "min_variance", "risk_parity")
+
+# Tool definition exposed to Claude (Anthropic tool-use schema)
+PORTFOLIO_TOOL = {
+    "name": "optimize_portfolio",
+    "description": (
+        "根据本地行情数据中的历史收益率，计算投资组合的最优权重。"
+        "支持均值-方差(mean_variance)、最小方差(min_variance)和风险平价(risk_parity)三种方法，"
+        "协方差矩阵使用OAS收缩估计。返回各资产权重、预期年化收益和年化波动率。"
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "symbols": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "资产代码列表，例如 [\"AAPL\", \"MSFT\"]"
+            },
+            "method": {
+                "type": "string",
+                "enum": list(METHODS),
+                "description": "优化方法，默认 mean_variance"
+            },
+            "lookback": {
+                "type": "integer",
+                "description": "使用最近多少期收益率，省略则使用全部共同历史"
+            },
+            "risk_aversion": {
+                "type": "number",
+                "description": "均值-方差优化的风险厌恶系数，默认 1.0"
+            },
+            "min_weight": {"type": "number", "description": "单一资产最小权重，默认 0"},
+            "max_weight": {"type": "number", "description": "单一资产最大权重，默认 1"}
+        },
+        "required": ["symbols"]
+    }
+}
+
+
+class _CovarianceState:
+    """Running moments of a return window, updated in batches"""
+
+    __slots__ = ("generation", "ends", "count", "mean", "m2")
+
+    def __init__(self, generation, ends, returns):
+        self.generation = generation
+        self.ends = ends
+        self.count = returns.shape[0]
+        self.mean = returns.mean(axis=0)
+        centered = returns - self.mean
+        self.m2 = centered.T @ centered
+
+    def add(self, returns):
+        """Merge a batch of rows (Chan et al. parallel update)"""
+        batch_count = returns.shape[0]
+        batch_mean = returns.mean(axis=0)
+        centered = returns - batch_mean
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.m2 += centered.T @ centered
+        self.m2 += np.outer(delta, delta) * (self.count * batch_count / total)
+        self.mean += delta * (batch_count / total)
+        self.count = total
+
+    def remove(self, returns):
+        """Remove a batch of rows previously merged into the window"""
+        batch_count = returns.shape[0]
+        batch_mean = returns.mean(axis=0)
+        centered = returns - batch_mean
+        remaining = self.count - batch_count
+        mean = (self.mean * self.count - batch_mean * batch_count) / remaining
+        delta = batch_mean - mean
+        self.m2 -= centered.T @ centered
+        self.m2 -= np.outer(delta, delta) * (remaining * batch_count / self.count)
+        self.mean = mean
+        self.count = remaining
+
+
+class PortfolioOptimizer:
+    def __init__(self, store=None, max_cached=32, periods_per_year=252):
+        self.store = store or price_store
+        self.max_cached = max_cached
+        self.periods_per_year = periods_per_year
+
+        # (symbols, lookback) -> _CovarianceState, least recently used first
+        self._cache = OrderedDict()
+        # Tool calls run in worker threads; cached moments are updated in place
+        self._lock = threading.Lock()
+
+    def get_covariance(self, symbols, lookback=None):
+        """
+        Get mean returns, the OAS-shrunk covariance matrix and the shrinkage
+        intensity for a set of symbols.
+
+        Moments are cached per (symbols, lookback) and only the rows added
+        (and, for a rolling window, dropped) since the last call are folded in.
+        """
+        mean, covariance, shrinkage, _ = self._estimate(symbols, lookback)
+        return mean, covariance, shrinkage
+
+    def optimize(self, symbols, method="mean_variance", lookback=None, risk_aversion=1.0,
+                 min_weight=0.0, max_weight=1.0, risk_budgets=None):
+        """Compute optimal portfolio weights from the stored return history"""
+        if method not in METHODS:
+            raise ValueError(f"Unknown optimization method: {method}")
+        if len(symbols) < 2:
+            raise ValueError("At least two symbols are required")
+        if len(set(symbols)) != len(symbols):
+            raise ValueError("Symbols must be unique")
+
+        n_assets = len(symbols)
+        if min_weight > max_weight or min_weight * n_assets > 1 or max_weight * n_assets < 1:
+            raise ValueError("Weight bounds cannot sum to 1")
+
+        mean, covariance, shrinkage, count = self._estimate(symbols, lookback)
+        # Flat prices give a zero covariance matrix, with no risk to trade off
+        if not np.trace(covariance) > 0:
+            raise ValueError("Prices did not change over the lookback window")
+
+        if method == "risk_parity":
+            weights = self._risk_parity(covariance, risk_budgets, min_weight, max_weight)
+        else:
+            if method == "min_variance":
+                weights = self._solve_qp(covariance, np.zeros(n_assets), 1.0,
+                                         min_weight, max_weight)
+            else:
+                if risk_aversion <= 0:
+                    raise ValueError("risk_aversion must be positive")
+                weights = self._solve_qp(covariance, mean, risk_aversion,
+                                         min_weight, max_weight)
+
+        portfolio_variance = float(weights @ covariance @ weights)
+        risk_contributions = weights * (covariance @ weights) / portfolio_variance
+
+        return {
+            "method": method,
+            "weights": dict(zip(symbols, weights.tolist())),
+            "riskContributions": dict(zip(symbols, risk_contributions.tolist())),
+            "expectedReturn": float(weights @ mean) * self.periods_per_year,
+            "volatility": float(np.sqrt(portfolio_variance * self.periods_per_year)),
+            "shrinkage": shrinkage,
+            "observations": count
+        }
+
+    def run_tool(self, tool_input):
+        """Entry point for the optimize_portfolio model tool"""
+        return self.optimize(
+            symbols=tool_input["symbols"],
+            method=tool_input.get("method", "mean_variance"),
+            lookback=tool_input.get("lookback"),
+            risk_aversion=tool_input.get("risk_aversion", 1.0),
+            min_weight=tool_input.get("min_weight", 0.0),
+            max_weight=tool_input.get("max_weight", 1.0)
+        )
+
+    def _estimate(self, symbols, lookback):
+        with self._lock:
+            state = self._get_state(tuple(symbols), lookback)
+            mean, count, sample = state.mean.copy(), state.count, state.m2 / (state.count - 1)
+        covariance, shrinkage = self._shrink(sample, count)
+        return mean, covariance, shrinkage, count
+
+    def _get_state(self, symbols, lookback):
+        lengths = []
+        for symbol in symbols:
+            length = self.store.get_length(symbol)
+            if length == 0:
+                raise ValueError(f"No price history for {symbol}")
+            lengths.append(length)
+
+        available = min(lengths) - 1
+        window = available if lookback is None else min(lookback, available)
+        if window < 2:
+            raise ValueError("At least three common prices are required per symbol")
+
+        key = (symbols, lookback)
+        state = self._cache.get(key)
+        if state is not None and state.generation == self.store.generation:
+            self._cache.move_to_end(key)
+            steps = {length - end for length, end in zip(lengths, state.ends)}
+            if steps == {0}:
+                return state
+            step = steps.pop() if len(steps) == 1 else -1
+            # Incremental update only when every series advanced in lockstep
+            if 0 < step and (lookback is None or (step < window and state.count == window)):
+                state.add(self.store.get_returns(symbols, lengths, step))
+                if lookback is not None:
+                    dropped_ends = [end - window + step for end in state.ends]
+                    state.remove(self.store.get_returns(symbols, dropped_ends, step))
+                state.ends = lengths
+                return state
+
+        state = _CovarianceState(self.store.generation, lengths, self.store.get_returns(symbols, lengths, window))
+        self._cache[key] = state
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return state
+
+    @staticmethod
+    def _shrink(sample, n_samples):
+        """Oracle Approximating Shrinkage towards a scaled identity (Chen et al. 2010)"""
+        n_features = sample.shape[0]
+        mu = np.trace(sample) / n_features
+        alpha = np.mean(sample ** 2)
+        numerator = alpha + mu ** 2
+        denominator = (n_samples + 1) * (alpha - mu ** 2 / n_features)
+        shrinkage = 1.0 if denominator == 0 else min(numerator / denominator, 1.0)
+
+        shrunk = (1.0 - shrinkage) * sample
+        shrunk.flat[::n_features + 1] += shrinkage * mu
+        return shrunk, float(shrinkage)
+
+    @staticmethod
+    def _project(values, lower, upper):
+        """Euclidean projection onto {w : sum(w) = 1, lower <= w <= upper}"""
+        # sum(clip(values - shift)) is piecewise linear in shift with kinks at
+        # values - upper and values - lower: bracket the root between two kinks
+        breakpoints = np.sort(np.concatenate((values - upper, values - lower)))
+        low, high = 0, breakpoints.size - 1
+        while high - low > 1:
+            middle = (low + high) // 2
+            if np.clip(values - breakpoints[middle], lower, upper).sum() > 1.0:
+                low = middle
+            else:
+                high = middle
+
+        total_low = np.clip(values - breakpoints[low], lower, upper).sum()
+        total_high = np.clip(values - breakpoints[high], lower, upper).sum()
+        shift = breakpoints[low]
+        if total_low != total_high:
+            shift += (total_low - 1.0) * (breakpoints[high] - breakpoints[low]) / (total_low - total_high)
+        return np.clip(values - shift, lower, upper)
+
+    def _solve_qp(self, covariance, mean, risk_aversion, lower, upper):
+        """Minimize risk_aversion/2 * w'Cw - mean'w subject to sum(w) = 1 and lower <= w <= upper"""
+        hessian = risk_aversion * covariance
+        weights = self._active_set(hessian, mean, lower, upper)
+        if weights is not None:
+            return weights
+
+        # Active-set iteration cycled: let a short run of first-order iterations
+        # identify the binding bounds, then solve exactly from that guess
+        estimate = self._accelerated_gradient(hessian, mean, lower, upper, max_iter=500, tol=1e-8)
+        tolerance = 1e-6 * (upper - lower)
+        weights = self._active_set(hessian, mean, lower, upper,
+                                   at_lower=estimate <= lower + tolerance,
+                                   at_upper=estimate >= upper - tolerance)
+        if weights is not None:
+            return weights
+        return self._accelerated_gradient(hessian, mean, lower, upper)
+
+    @staticmethod
+    def _active_set(hessian, mean, lower, upper, at_lower=None, at_upper=None, max_iter=100):
+        """Primal-dual active-set method (Hintermueller et al. 2002); None if it does not converge"""
+        n_assets = hessian.shape[0]
+        scale = float(np.mean(np.diag(hessian)))
+        if at_lower is None:
+            at_lower = np.zeros(n_assets, dtype=bool)
+        if at_upper is None:
+            at_upper = np.zeros(n_assets, dtype=bool)
+        at_upper = at_upper & ~at_lower
+
+        for _ in range(max_iter):
+            free = ~(at_lower | at_upper)
+            n_free = int(free.sum())
+            if n_free == 0:
+                return None
+
+            weights = np.where(at_upper, float(upper), float(lower))
+            weights[free] = 0.0
+            bound_part = hessian[free] @ weights
+
+            # KKT system on the free set: H_FF w_F + nu * 1 = mean_F - H_FB w_B, sum(w) = 1
+            system = np.empty((n_free + 1, n_free + 1))
+            system[:n_free, :n_free] = hessian[np.ix_(free, free)]
+            system[:n_free, n_free] = 1.0
+            system[n_free, :n_free] = 1.0
+            system[n_free, n_free] = 0.0
+            rhs = np.empty(n_free + 1)
+            rhs[:n_free] = mean[free] - bound_part
+            rhs[n_free] = 1.0 - weights[~free].sum()
+            try:
+                solution = np.linalg.solve(system, rhs)
+            except np.linalg.LinAlgError:
+                return None
+            weights[free] = solution[:n_free]
+
+            # Positive entries are multipliers of the lower bound, negative of the upper
+            multipliers = hessian @ weights - mean + solution[n_free]
+            multipliers[free] = 0.0
+
+            next_lower = multipliers + scale * (lower - weights) > 0
+            next_upper = multipliers + scale * (upper - weights) < 0
+            if np.array_equal(next_lower, at_lower) and np.array_equal(next_upper, at_upper):
+                return weights
+            at_lower, at_upper = next_lower, next_upper & ~next_lower
+        return None
+
+    def _accelerated_gradient(self, hessian, mean, lower, upper, max_iter=20000, tol=1e-10):
+        """Projected gradient with Nesterov momentum and adaptive restarts (FISTA)"""
+        n_assets = hessian.shape[0]
+
+        # Lipschitz constant of the gradient from a few power iterations
+        vector = np.full(n_assets, 1.0 / np.sqrt(n_assets))
+        for _ in range(50):
+            vector = hessian @ vector
+            vector /= np.linalg.norm(vector)
+        step = 1.0 / (1.05 * float(vector @ hessian @ vector))
+
+        weights = self._project(np.full(n_assets, 1.0 / n_assets), lower, upper)
+        momentum = weights
+        t = 1.0
+        for _ in range(max_iter):
+            gradient = hessian @ momentum - mean
+            updated = self._project(momentum - step * gradient, lower, upper)
+            change = updated - weights
+            if change @ change < tol * tol:
+                return updated
+            if gradient @ change > 0:
+                # Momentum is pointing uphill: restart from the latest iterate
+                momentum, t = updated, 1.0
+            else:
+                t_next = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t * t))
+                momentum = updated + ((t - 1.0) / t_next) * change
+                t = t_next
+            weights = updated
+        return weights
+
+    @staticmethod
+    def _risk_parity(covariance, risk_budgets=None, lower=0.0, upper=1.0, max_sweeps=500, tol=1e-8):
+        """
+        Long-only risk budgeting by cyclical coordinate descent (Griveau-Billion et al. 2013).
+
+        When the budgeted weights break the bounds, solves the constrained risk
+        budgeting problem instead (Richard and Roncalli 2019): minimize
+        w'Cw/2 - lam * sum(b * log(w)) with every coordinate update clipped to
+        the bounds, bisecting on lam until the weights sum to 1. Risk
+        contributions then match the budgets only for assets off their bounds.
+        """
+        n_assets = covariance.shape[0]
+        if risk_budgets is None:
+            budgets = np.full(n_assets, 1.0 / n_assets)
+        else:
+            budgets = np.asarray(risk_budgets, dtype=np.float64)
+            if budgets.shape != (n_assets,) or np.any(budgets <= 0):
+                raise ValueError("risk_budgets must be positive and match the number of symbols")
+            budgets = budgets / budgets.sum()
+
+        variances = np.diag(covariance).copy()
+        x = 1.0 / np.sqrt(variances)
+        x /= x.sum()
+        x = PortfolioOptimizer._budget_descent(covariance, variances, budgets, 1.0, x,
+                                               0.0, np.inf, max_sweeps, tol)
+        weights = x / x.sum()
+        if np.all(weights >= lower - 1e-12) and np.all(weights <= upper + 1e-12):
+            return weights
+
+        # Unbounded weights scale with sqrt(lam), so this lam makes them sum to 1;
+        # with the bounds the weight sum still increases with lam
+        lam = 1.0 / x.sum() ** 2
+        low, high = 0.0, np.inf
+        x = np.clip(weights, max(lower, 1e-12), upper)
+        for _ in range(200):
+            x = PortfolioOptimizer._budget_descent(covariance, variances, budgets, lam, x,
+                                                   lower, upper, max_sweeps, tol)
+            total = x.sum()
+            if abs(total - 1.0) < 1e-10:
+                break
+            if total < 1.0:
+                low = lam
+                lam = lam * 4.0 if high == np.inf else np.sqrt(lam * high)
+            else:
+                high = lam
+                lam = lam / 4.0 if low == 0.0 else np.sqrt(low * lam)
+        return np.clip(x / x.sum(), lower, upper)
+
+    @staticmethod
+    def _budget_descent(covariance, variances, budgets, lam, x, lower, upper, max_sweeps, tol):
+        """Coordinate descent on w'Cw/2 - lam * sum(b * log(w)) subject to lower <= w <= upper"""
+        x = x.copy()
+        marginal = covariance @ x
+        for _ in range(max_sweeps):
+            largest_change = 0.0
+            for i in range(x.size):
+                others = marginal[i] - variances[i] * x[i]
+                updated = (-others + np.sqrt(others * others + 4.0 * variances[i] * lam * budgets[i])) / (2.0 * variances[i])
+                updated = min(max(updated, lower), upper)
+                delta = updated - x[i]
+                if delta != 0.0:
+                    marginal += covariance[i] * delta
+                    x[i] = updated
+                    largest_change = max(largest_change, abs(delta) / updated)
+            if largest_change < tol:
+                break
+        return x
+
+
+# Shared optimizer used by the API endpoints and model tools
+portfolio_optimizer = PortfolioOptimizer()
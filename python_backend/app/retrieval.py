@@ -0,0 +1,739 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import numpy as np
+
+# Latin words/numbers, or runs of CJK ideographs
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.'][a-z0-9]+)*|[\u3400-\u4dbf\u4e00-\u9fff]+")
+_CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff]")
+_CJK_START = "\u3400"
+
+# Term frequencies are stored as uint16
+_MAX_TF = np.iinfo(np.uint16).max
+
+# Postings handled per step of a segment merge, which bounds its memory use
+_MERGE_CHUNK_POSTINGS = 1 << 22
+
+# Terms in more than 1 / _DENSE_RATIO of a segment's passages also get a dense
+# per-passage tf row, which takes less space than their postings
+_DENSE_RATIO = 3
+
+# Largest number of passages a search may return
+MAX_SEARCH_RESULTS = 50
+
+
+def tokenize(text):
+    """
+    Split text into index terms: lowercase Latin words and numbers, and
+    overlapping character bigrams for Chinese (a single character stays a unigram).
+    """
+    text = text.lower()
+    if not _CJK_PATTERN.search(text):
+        return _TOKEN_PATTERN.findall(text)
+
+    tokens = []
+    for match in _TOKEN_PATTERN.findall(text):
+        if match[0] >= _CJK_START:
+            if len(match) == 1:
+                tokens.append(match)
+            else:
+                tokens.extend(match[i:i + 2] for i in range(len(match) - 1))
+        else:
+            tokens.append(match)
+    return tokens
+
+
+def split_passages(text, max_chars=400):
+    """Split a document into passages of about `max_chars`, on paragraph and sentence boundaries"""
+    passages = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Keep sentence-ending punctuation attached to its sentence
+        for sentence in re.split(r"(?<=[。！？!?；;])|(?<=\.)\s+", paragraph):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                passages.append(current)
+                current = ""
+            while len(sentence) > max_chars:
+                passages.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            current = f"{current} {sentence}" if current else sentence
+        if current and len(current) >= max_chars // 2:
+            passages.append(current)
+            current = ""
+    if current:
+        passages.append(current)
+    return passages
+
+
+def _term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode(), digest_size=8).digest(), "little")
+
+
+class _Segment:
+    """
+    An immutable, memory-mapped slice of the index.
+
+    Terms are stored as sorted 64-bit hashes; the postings of term i are
+    docs[offsets[i]:offsets[i + 1]] with matching term frequencies in tfs.
+    Common terms also have a row of dense_tfs with a tf for every passage.
+    Nothing is read into memory until a query touches it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.base = meta["base"]
+        self.count = meta["count"]
+        self.total_length = meta["totalLength"]
+
+        self.terms = self._load("terms")
+        self.offsets = self._load("offsets")
+        self.docs = self._load("docs")
+        self.tfs = self._load("tfs")
+        self.lengths = self._load("lengths")
+        self.passage_offsets = self._load("passage_offsets")
+        self.dense_terms = self._load("dense_terms")
+        self.dense_tfs = self._load("dense_tfs")
+        # Passage lengths as float32, loaded by the first query with a common term
+        self._float_lengths = None
+        self._passages = np.memmap(os.path.join(path, "passages.bin"), dtype=np.uint8, mode="r") \
+            if self.passage_offsets[-1] > 0 else np.empty(0, dtype=np.uint8)
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    def postings(self, term_hash):
+        index = np.searchsorted(self.terms, term_hash)
+        if index == self.terms.size or self.terms[index] != term_hash:
+            return None
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.docs[start:end], self.tfs[start:end]
+
+    def float_lengths(self):
+        if self._float_lengths is None:
+            self._float_lengths = np.asarray(self.lengths, dtype=np.float32)
+        return self._float_lengths
+
+    def dense(self, term_hash):
+        """Dense tf row of a common term, or None"""
+        index = np.searchsorted(self.dense_terms, term_hash)
+        if index == self.dense_terms.size or self.dense_terms[index] != term_hash:
+            return None
+        return self.dense_tfs[index]
+
+    def passage(self, local_id):
+        start, end = self.passage_offsets[local_id], self.passage_offsets[local_id + 1]
+        return json.loads(self._passages[start:end].tobytes())
+
+
+class _Buffer:
+    """Passages added since the last flush, with the same lookup interface as _Segment"""
+
+    def __init__(self, base):
+        self.base = base
+        self.count = 0
+        self.total_length = 0
+        self.records = []
+        self.lengths = np.empty(1024, dtype=np.uint32)
+
+        # term hash -> ([local ids], [term frequencies])
+        self._postings = {}
+
+    def add(self, token_counts, term_hashes, record):
+        """Index a passage from its token counts, hashing unseen tokens into `term_hashes`"""
+        local_id = self.count
+        postings = self._postings
+        for token, tf in token_counts.items():
+            term_hash = term_hashes.get(token)
+            if term_hash is None:
+                term_hash = term_hashes[token] = _term_hash(token)
+            entry = postings.get(term_hash)
+            if entry is None:
+                postings[term_hash] = ([local_id], [tf])
+            else:
+                entry[0].append(local_id)
+                entry[1].append(tf)
+        length = sum(token_counts.values())
+
+        if local_id == self.lengths.size:
+            grown = np.empty(self.lengths.size * 2, dtype=np.uint32)
+            grown[:local_id] = self.lengths
+            self.lengths = grown
+        self.lengths[local_id] = length
+        self.records.append(record)
+        self.count += 1
+        self.total_length += length
+
+    def postings(self, term_hash):
+        entry = self._postings.get(term_hash)
+        if entry is None:
+            return None
+        return np.asarray(entry[0], dtype=np.uint32), np.minimum(entry[1], _MAX_TF).astype(np.uint16)
+
+    def dense(self, term_hash):
+        return None
+
+    def passage(self, local_id):
+        return self.records[local_id]
+
+    def arrays(self):
+        """Flatten the postings into per-posting (term, doc, tf) arrays"""
+        values = self._postings.values()
+        sizes = np.fromiter((len(ids) for ids, _ in values), dtype=np.int64, count=len(self._postings))
+        terms = np.repeat(np.fromiter(self._postings.keys(), dtype=np.uint64, count=len(self._postings)), sizes)
+        total = int(sizes.sum())
+        docs = np.fromiter(chain.from_iterable(ids for ids, _ in values), dtype=np.uint32, count=total)
+        tfs = np.fromiter(chain.from_iterable(tfs for _, tfs in values), dtype=np.int64, count=total)
+        return terms, docs, np.minimum(tfs, _MAX_TF).astype(np.uint16)
+
+
+class SearchIndex:
+    """
+    Incremental BM25 index over filings, reports and chat messages.
+
+    New passages go to an in-memory buffer that is flushed to an immutable
+    on-disk segment every `flush_threshold` passages. Buffered passages are
+    also appended to a write-ahead log, replayed on startup, so passage ids
+    handed out before a crash are never reused. Segments are opened
+    with memory mapping, so the index can exceed RAM and opens without
+    reading postings.
+
+    Flushes and merges run on a background thread; a full buffer stays
+    searchable until its segment is written. Segments are merged by size
+    tier: `merge_factor` adjacent segments of the same tier become one
+    segment of the next tier, so each passage is rewritten about
+    log(passages / flush_threshold) / log(merge_factor) times.
+    """
+
+    def __init__(self, directory=None, flush_threshold=20000, merge_factor=4, k1=1.2, b=0.75):
+        self.directory = directory or os.getenv("SEARCH_INDEX_DIR", "data/search_index")
+        self.flush_threshold = flush_threshold
+        self.merge_factor = merge_factor
+        self.k1 = k1
+        self.b = b
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._segments = [_Segment(os.path.join(self.directory, name)) for name in self._read_manifest()]
+        next_id = self._segments[-1].base + self._segments[-1].count if self._segments else 0
+        self._buffer = _Buffer(next_id)
+
+        # Full buffers waiting for the background writer, oldest first
+        self._flushing = []
+        # Guards _segments and _flushing, which the background writer replaces
+        self._lock = threading.Lock()
+        # One worker, so segments are written and merged in passage id order
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+
+        # token -> term hash, so repeated words are hashed once
+        self._term_hashes = {}
+
+        # session id -> first passage id still visible after the session was cleared
+        self._cleared_sessions = self._read_json("cleared_sessions.json", {})
+
+        self._recover()
+        self._log = open(self._log_path(), "a", encoding="utf-8")
+
+    def add_passage(self, text, source, title="", ref=""):
+        """Index one passage and return its id"""
+        return self._add([{"text": text, "source": source, "title": title, "ref": ref}])[0]
+
+    def add_passages(self, texts, source, title="", ref=""):
+        """Index several passages with one log write and return their ids"""
+        return self._add([{"text": text, "source": source, "title": title, "ref": ref} for text in texts])
+
+    def add_document(self, text, source, title="", ref="", max_chars=400):
+        """Split a document into passages, index them and return their ids"""
+        return self.add_passages(split_passages(text, max_chars), source, title, ref)
+
+    def get_passage(self, passage_id):
+        """Get a stored passage with its citation id"""
+        return self._get_passage(self._parts(), passage_id)
+
+    def _get_passage(self, parts, passage_id):
+        for segment in parts:
+            if segment.base <= passage_id < segment.base + segment.count:
+                record = dict(segment.passage(passage_id - segment.base))
+                record["id"] = passage_id
+                record["citation"] = f"P{passage_id}"
+                return record
+        return None
+
+    def search(self, query, k=5, session_id=None):
+        """
+        Return the top `k` passages for a query by BM25 score. Chat passages
+        are only returned to the session they came from.
+        """
+        if not 1 <= k <= MAX_SEARCH_RESULTS:
+            raise ValueError(f"k must be between 1 and {MAX_SEARCH_RESULTS}")
+        term_hashes = {self._term_hashes.get(token) or _term_hash(token) for token in tokenize(query)}
+        parts = [segment for segment in self._parts() if segment.count > 0]
+        total_docs = sum(segment.count for segment in parts)
+        if not term_hashes or total_docs == 0:
+            return []
+        average_length = sum(segment.total_length for segment in parts) / total_docs
+
+        # Postings per segment, and document frequencies across the whole index
+        postings = [[] for _ in parts]
+        document_frequency = dict.fromkeys(term_hashes, 0)
+        for position, segment in enumerate(parts):
+            for term_hash in term_hashes:
+                found = segment.postings(term_hash)
+                if found is not None:
+                    postings[position].append((term_hash, found))
+                    document_frequency[term_hash] += found[0].size
+
+        # segment -> weighted postings, for segments that may still hold unseen candidates
+        pending = {}
+        for segment, segment_postings in zip(parts, postings):
+            if segment_postings:
+                pending[segment] = [
+                    (np.log(1.0 + (total_docs - document_frequency[term_hash] + 0.5) / (document_frequency[term_hash] + 0.5)),
+                     docs, tfs, segment.dense(term_hash))
+                    for term_hash, (docs, tfs) in segment_postings
+                ]
+
+        # Chat passages from other sessions are filtered out after ranking, so fetch extra
+        # candidates, and widen the cut-off until k visible passages are found or no
+        # segment has more matches
+        limit = k * 4
+        exhausted = []
+        while True:
+            candidates = list(exhausted)
+            for segment, weighted in list(pending.items()):
+                ids, totals = self._top_documents(segment, weighted, limit, average_length)
+                found = list(zip(totals.tolist(), (ids.astype(np.int64) + segment.base).tolist()))
+                candidates.extend(found)
+                if ids.size < limit:
+                    # Every match in the segment is a candidate already
+                    exhausted.extend(found)
+                    del pending[segment]
+
+            candidates.sort(reverse=True)
+            results = []
+            for score, passage_id in candidates:
+                passage = self._get_passage(parts, passage_id)
+                if passage["source"] == "chat" and (
+                        passage["ref"] != session_id or passage_id < self._cleared_sessions.get(session_id, 0)):
+                    continue
+                passage["score"] = score
+                results.append(passage)
+                if len(results) == k:
+                    return results
+            if not pending:
+                return results
+            limit *= 4
+
+    def clear_session(self, session_id):
+        """Hide the chat passages indexed so far for a session"""
+        self._cleared_sessions[session_id] = self._buffer.base + self._buffer.count
+        self._write_json("cleared_sessions.json", self._cleared_sessions)
+
+    def format_context(self, results):
+        """Render search results as a prompt section with citation ids"""
+        if not results:
+            return ""
+        lines = ["以下是检索到的参考资料。引用原文时，请在句末用方括号标注编号，例如 [P12]："]
+        for result in results:
+            label = f"《{result['title']}》" if result["title"] else ""
+            lines.append(f"[{result['citation']}] {label}({result['source']}) {result['text']}")
+        return "\n".join(lines)
+
+    def flush(self):
+        """Write buffered passages to disk, waiting for pending flushes and merges"""
+        buffer = self._freeze()
+        self._writer.submit(self._write_buffer, buffer).result()
+
+    def stats(self):
+        """Index size summary"""
+        with self._lock:
+            segments, flushing = list(self._segments), list(self._flushing)
+        return {
+            "passages": sum(part.count for part in chain(segments, flushing)) + self._buffer.count,
+            "segments": len(segments),
+            "segmentSizes": [segment.count for segment in segments],
+            "buffered": sum(buffer.count for buffer in flushing) + self._buffer.count
+        }
+
+    def _parts(self):
+        """Segments, buffers being flushed and the current buffer, in passage id order"""
+        with self._lock:
+            return self._segments + self._flushing + [self._buffer]
+
+    def _freeze(self):
+        """Hand the current buffer to the background writer and start a new one"""
+        buffer = self._buffer
+        if buffer.count == 0:
+            return None
+        with self._lock:
+            self._flushing.append(buffer)
+            self._buffer = _Buffer(buffer.base + buffer.count)
+        self._log.close()
+        self._log = open(self._log_path(), "a", encoding="utf-8")
+        return buffer
+
+    def _write_buffer(self, buffer):
+        """Write a frozen buffer to a segment, then merge; runs on the writer thread"""
+        try:
+            if buffer is not None:
+                self._flush_buffer(buffer)
+            self._merge_tiers()
+        except Exception as error:
+            # The buffer stays searchable and its log is replayed on the next start
+            print(f"Error writing search index segment: {error}")
+
+    def _flush_buffer(self, buffer):
+        terms, docs, tfs = buffer.arrays()
+        blobs = [json.dumps(record, ensure_ascii=False).encode() for record in buffer.records]
+        name = self._write_segment(buffer.base, terms, docs, tfs, buffer.lengths[:buffer.count],
+                                   blobs, buffer.total_length)
+        segment = _Segment(os.path.join(self.directory, name))
+        with self._lock:
+            self._segments.append(segment)
+            if buffer in self._flushing:
+                self._flushing.remove(buffer)
+            self._write_manifest()
+
+        # The flushed passages are in the manifest now, so their log can go
+        try:
+            os.remove(self._log_path(buffer.base))
+        except FileNotFoundError:
+            pass
+
+    def _add(self, records):
+        """Log passages to the write-ahead log, then index them"""
+        base = self._buffer.base + self._buffer.count
+        lines = [json.dumps(dict(record, id=base + offset), ensure_ascii=False) + "\n"
+                 for offset, record in enumerate(records)]
+        self._log.write("".join(lines))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+        for record in records:
+            self._index(record)
+        if self._buffer.count >= self.flush_threshold:
+            self._writer.submit(self._write_buffer, self._freeze())
+        return list(range(base, base + len(records)))
+
+    def _index(self, record):
+        self._buffer.add(Counter(tokenize(record["text"])), self._term_hashes, record)
+
+    def _log_path(self, base=None):
+        return os.path.join(self.directory, f"buffer_{self._buffer.base if base is None else base:012d}.log")
+
+    def _recover(self):
+        """Replay write-ahead logs left by a crash and flush them to a segment"""
+        logs = sorted(name for name in os.listdir(self.directory)
+                      if name.startswith("buffer_") and name.endswith(".log"))
+        for name in logs:
+            with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A write torn by the crash; nothing after it was acknowledged
+                        break
+                    passage_id = record.pop("id")
+                    # Passages that reached a segment before the crash are skipped
+                    if passage_id == self._buffer.base + self._buffer.count:
+                        self._index(record)
+
+        if self._buffer.count > 0:
+            buffer = self._buffer
+            self._buffer = _Buffer(buffer.base + buffer.count)
+            self._flush_buffer(buffer)
+        for name in logs:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _bm25(self, idf, docs, tfs, average_length, lengths):
+        tf = tfs.astype(np.float32)
+        norm = np.float32(self.k1 * (1.0 - self.b)) + np.float32(self.k1 * self.b / average_length) * lengths[docs]
+        return np.float32(idf * (self.k1 + 1.0)) * tf / (tf + norm)
+
+    def _top_documents(self, segment, weighted, limit, average_length):
+        """
+        Exact top-`limit` documents of one segment, with MaxScore pruning.
+
+        A term adds at most idf * (k1 + 1) to a score. Terms are taken in
+        decreasing idf order, and only documents that contain one of these
+        "essential" terms are scored. The rare terms usually settle the top
+        documents before the long postings of common terms need a full scan.
+        Common terms are then looked up only for the candidate documents.
+
+        Terms with a dense tf row are scored with whole-array arithmetic
+        instead of scattering their postings, and candidate lookups into
+        them are direct indexing.
+        """
+        weighted = sorted(weighted, key=lambda item: item[0], reverse=True)
+        bounds = np.array([idf * (self.k1 + 1.0) for idf, _, _, _ in weighted])
+        remaining = np.append(np.cumsum(bounds[::-1])[::-1], 0.0)
+        norm = None
+
+        for split in range(1, len(weighted) + 1):
+            essential = weighted[:split]
+            if any(row is not None for _, _, _, row in essential):
+                # A common term matches most documents, so accumulate over all of them
+                if norm is None:
+                    norm = np.float32(self.k1 * self.b / average_length) * segment.float_lengths()
+                    norm += np.float32(self.k1 * (1.0 - self.b))
+                dense_totals = np.zeros(segment.count, dtype=np.float32)
+                for idf, docs, tfs, row in essential:
+                    if row is not None:
+                        tf = row.astype(np.float32)
+                        np.divide(tf, tf + norm, out=tf)
+                        tf *= np.float32(idf * (self.k1 + 1.0))
+                        dense_totals += tf
+                    else:
+                        dense_totals[docs] += self._bm25(idf, docs, tfs, average_length, segment.lengths)
+
+                # Select candidates straight from the dense totals
+                if segment.count > limit:
+                    floor = np.partition(dense_totals, -limit)[-limit]
+                    if split == len(weighted):
+                        keep = dense_totals >= max(floor, np.float32(1e-30))
+                    else:
+                        keep = (dense_totals > 0) & (dense_totals + np.float32(remaining[split]) >= floor)
+                    ids = np.flatnonzero(keep)
+                else:
+                    ids = np.flatnonzero(dense_totals)
+                totals = dense_totals[ids].astype(np.float64)
+            else:
+                docs = np.concatenate([docs for _, docs, _, _ in essential])
+                scores = np.concatenate([
+                    self._bm25(idf, docs, tfs, average_length, segment.lengths)
+                    for idf, docs, tfs, _ in essential
+                ])
+                ids, totals = self._accumulate(docs, scores, segment.count)
+
+            # Final scores are at least the partial ones, so the `limit`-th best partial score is
+            # a floor for the final cut-off; drop candidates that cannot reach it
+            if ids.size > limit and split < len(weighted):
+                floor = np.partition(totals, -limit)[-limit]
+                keep = totals + remaining[split] >= floor
+                ids, totals = ids[keep], totals[keep]
+
+            # Complete candidate scores from the non-essential terms (postings are sorted by document)
+            for idf, term_docs, tfs, row in weighted[split:]:
+                if row is not None:
+                    totals += self._bm25(idf, ids, row[ids], average_length, segment.lengths)
+                    continue
+                if ids.size * 4 > term_docs.size:
+                    # Many candidates: scattering the whole posting list is cheaper than binary searches
+                    dense = np.zeros(segment.count, dtype=np.float32)
+                    dense[term_docs] = self._bm25(idf, term_docs, tfs, average_length, segment.lengths)
+                    totals += dense[ids]
+                    continue
+                positions = np.minimum(np.searchsorted(term_docs, ids), term_docs.size - 1)
+                hit = term_docs[positions] == ids
+                if hit.any():
+                    positions = positions[hit]
+                    totals[hit] += self._bm25(idf, term_docs[positions], tfs[positions], average_length, segment.lengths)
+
+            if ids.size > limit:
+                top = np.argpartition(totals, -limit)[-limit:]
+                ids, totals = ids[top], totals[top]
+            # Unscored documents cannot beat the current top `limit`
+            if split == len(weighted) or (ids.size == limit and remaining[split] <= totals.min()):
+                return ids, totals
+
+    @staticmethod
+    def _accumulate(docs, scores, count):
+        """Sum scores per document: dense when many documents match, sparse otherwise"""
+        if docs.size * 8 > count:
+            totals = np.bincount(docs, weights=scores, minlength=count)
+            ids = np.flatnonzero(totals)
+            return ids, totals[ids]
+        ids, inverse = np.unique(docs, return_inverse=True)
+        return ids, np.bincount(inverse, weights=scores)
+
+    def _tier(self, count):
+        """Size tier of a segment: tier t holds flush_threshold * merge_factor ** t passages or more"""
+        tier, size = 0, self.flush_threshold * self.merge_factor
+        while count >= size:
+            tier += 1
+            size *= self.merge_factor
+        return tier
+
+    def _merge_tiers(self):
+        """Merge runs of `merge_factor` adjacent same-tier segments until none are left"""
+        while True:
+            segments = list(self._segments)
+            tiers = [self._tier(segment.count) for segment in segments]
+            run = next((start for start in range(len(tiers) - self.merge_factor + 1)
+                        if len(set(tiers[start:start + self.merge_factor])) == 1), None)
+            if run is None:
+                return
+
+            merging = segments[run:run + self.merge_factor]
+            merged = _Segment(os.path.join(self.directory, self._merge_segments(merging)))
+            with self._lock:
+                self._segments[run:run + self.merge_factor] = [merged]
+                self._write_manifest()
+            # Open memory maps keep the files readable for searches still using them
+            for segment in merging:
+                shutil.rmtree(segment.path, ignore_errors=True)
+
+    def _merge_segments(self, segments):
+        """
+        Stream adjacent segments into one new segment.
+
+        The term hash space is cut into ranges of about _MERGE_CHUNK_POSTINGS
+        postings. Each range is a contiguous slice of every input segment, so
+        postings are read from the memory maps and written to the output one
+        range at a time, never holding whole segments in memory. A stable sort
+        by term keeps documents ascending, since the segments are in id order.
+        """
+        base = segments[0].base
+        count = sum(segment.count for segment in segments)
+        total_postings = sum(segment.docs.size for segment in segments)
+        name, temporary = self._start_segment(base, count)
+
+        # Term and posting positions of each hash range in each segment
+        chunks = max(1, total_postings // _MERGE_CHUNK_POSTINGS)
+        bounds = [np.uint64((1 << 64) * step // chunks) for step in range(chunks)]
+        ranges = []
+        term_count = 0
+        for step in range(chunks):
+            segment_ranges = []
+            for segment in segments:
+                start = int(np.searchsorted(segment.terms, bounds[step]))
+                end = int(np.searchsorted(segment.terms, bounds[step + 1])) if step + 1 < chunks else segment.terms.size
+                segment_ranges.append((start, end))
+            ranges.append(segment_ranges)
+            term_count += np.unique(np.concatenate([
+                segment.terms[start:end] for segment, (start, end) in zip(segments, segment_ranges)
+            ])).size
+
+        out = {
+            array_name: np.lib.format.open_memmap(os.path.join(temporary, f"{array_name}.npy"), mode="w+",
+                                                  dtype=dtype, shape=(size,))
+            for array_name, dtype, size in (("terms", np.uint64, term_count), ("offsets", np.int64, term_count + 1),
+                                            ("docs", np.uint32, total_postings), ("tfs", np.uint16, total_postings),
+                                            ("lengths", np.uint32, count), ("passage_offsets", np.int64, count + 1))
+        }
+
+        term_position = posting_position = 0
+        for segment_ranges in ranges:
+            terms, docs, tfs = [], [], []
+            for segment, (start, end) in zip(segments, segment_ranges):
+                first, last = segment.offsets[start], segment.offsets[end]
+                terms.append(np.repeat(segment.terms[start:end], np.diff(segment.offsets[start:end + 1])))
+                docs.append(segment.docs[first:last] + np.uint32(segment.base - base))
+                tfs.append(segment.tfs[first:last])
+            terms = np.concatenate(terms)
+            order = np.argsort(terms, kind="stable")
+            size = terms.size
+            out["docs"][posting_position:posting_position + size] = np.concatenate(docs)[order]
+            out["tfs"][posting_position:posting_position + size] = np.concatenate(tfs)[order]
+            unique_terms, starts = np.unique(terms[order], return_index=True)
+            out["terms"][term_position:term_position + unique_terms.size] = unique_terms
+            out["offsets"][term_position:term_position + unique_terms.size] = starts + posting_position
+            term_position += unique_terms.size
+            posting_position += size
+        out["offsets"][term_position] = posting_position
+
+        position = shift = 0
+        out["passage_offsets"][0] = 0
+        with open(os.path.join(temporary, "passages.bin"), "wb") as passages:
+            for segment in segments:
+                out["lengths"][position:position + segment.count] = segment.lengths
+                out["passage_offsets"][position + 1:position + 1 + segment.count] = segment.passage_offsets[1:] + shift
+                position += segment.count
+                shift += int(segment.passage_offsets[-1])
+                with open(os.path.join(segment.path, "passages.bin"), "rb") as source:
+                    shutil.copyfileobj(source, passages)
+        for array in out.values():
+            array.flush()
+        self._write_dense(temporary, out["terms"], out["offsets"], out["docs"], out["tfs"], count)
+        del out
+
+        return self._finish_segment(name, temporary, base, count,
+                                    sum(segment.total_length for segment in segments))
+
+    def _start_segment(self, base, count):
+        name = f"segment_{base:012d}_{count:09d}"
+        temporary = os.path.join(self.directory, name + ".tmp")
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        return name, temporary
+
+    def _finish_segment(self, name, temporary, base, count, total_length):
+        with open(os.path.join(temporary, "meta.json"), "w") as f:
+            json.dump({"base": base, "count": count, "totalLength": int(total_length)}, f)
+        path = os.path.join(self.directory, name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(temporary, path)
+        return name
+
+    def _write_segment(self, base, terms, docs, tfs, lengths, blobs, total_length):
+        name, temporary = self._start_segment(base, len(lengths))
+
+        # Group postings by term, with documents ascending within each term
+        order = np.lexsort((docs, terms))
+        terms, docs, tfs = terms[order], docs[order], tfs[order]
+        unique_terms, starts = np.unique(terms, return_index=True)
+        offsets = np.append(starts, terms.size).astype(np.int64)
+        passage_offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        np.cumsum([len(blob) for blob in blobs], out=passage_offsets[1:])
+
+        for array_name, values in (("terms", unique_terms), ("offsets", offsets), ("docs", docs),
+                                   ("tfs", tfs), ("lengths", np.asarray(lengths, dtype=np.uint32)),
+                                   ("passage_offsets", passage_offsets)):
+            np.save(os.path.join(temporary, f"{array_name}.npy"), values)
+        with open(os.path.join(temporary, "passages.bin"), "wb") as f:
+            for blob in blobs:
+                f.write(blob)
+        self._write_dense(temporary, unique_terms, offsets, docs, tfs, len(lengths))
+        return self._finish_segment(name, temporary, base, len(lengths), total_length)
+
+    @staticmethod
+    def _write_dense(temporary, terms, offsets, docs, tfs, count):
+        """Write dense tf rows for the common terms of a segment, one row at a time"""
+        common = np.flatnonzero(np.diff(offsets) * _DENSE_RATIO > count)
+        np.save(os.path.join(temporary, "dense_terms.npy"), np.asarray(terms[common], dtype=np.uint64))
+        rows = np.lib.format.open_memmap(os.path.join(temporary, "dense_tfs.npy"), mode="w+",
+                                         dtype=np.uint16, shape=(common.size, count))
+        for row, index in enumerate(common):
+            start, end = offsets[index], offsets[index + 1]
+            rows[row, docs[start:end]] = tfs[start:end]
+        rows.flush()
+
+    def _read_manifest(self):
+        return self._read_json("segments.json", [])
+
+    def _write_manifest(self):
+        self._write_json("segments.json", [os.path.basename(segment.path) for segment in self._segments])
+
+    def _read_json(self, name, default):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def _write_json(self, name, value):
+        # Write then rename, so readers never see a partial file
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(value, f)
+        os.replace(path + ".tmp", path)
+
+
+# Shared index used by the API endpoints and chat prompts
+search_index = SearchIndex()
@@ -0,0 +1,156 @@
+import asyncio
+import inspect
+import json
+import time
+from collections import OrderedDict
+
+from app.indicators import INDICATOR_TOOL, indicator_engine
+from app.market_data import price_store
+from app.portfolio_optimizer import PORTFOLIO_TOOL, portfolio_optimizer
+
+
+class ToolRegistry:
+    """Tools Claude can call, executed concurrently with timeouts and a result cache"""
+
+    def __init__(self, default_timeout=10.0, cache_ttl=60.0, max_cached=256):
+        self.default_timeout = default_timeout
+        self.cache_ttl = cache_ttl
+        self.max_cached = max_cached
+
+        # name -> definition, handler, timeout, cacheable flag and data version function
+        self._tools = {}
+
+        # (name, canonical input, data version) -> (expires_at, result), least recently used first
+        self._cache = OrderedDict()
+        # (name, canonical input, data version) -> running task, shared by identical concurrent calls
+        self._pending = {}
+
+    def register(self, definition, handler, timeout=None, cacheable=True, version=None):
+        """
+        Register a tool. `definition` follows the Anthropic tool schema
+        (name, description, input_schema); `handler` takes the tool input dict
+        and may be a plain function or a coroutine function. `version`, if
+        given, maps the tool input to a value that changes whenever the data
+        behind the result does; it is part of the cache key.
+        """
+        self._tools[definition["name"]] = {
+            "definition": definition,
+            "handler": handler,
+            "timeout": timeout or self.default_timeout,
+            "cacheable": cacheable,
+            "version": version
+        }
+
+    def definitions(self):
+        """Tool definitions for the request body"""
+        return [tool["definition"] for tool in self._tools.values()]
+
+    def __len__(self):
+        return len(self._tools)
+
+    async def execute_all(self, tool_uses):
+        """
+        Execute every tool_use block from one assistant turn concurrently.
+
+        Returns the tool_result content blocks, in the same order as the
+        requests, and a trace entry per call with its latency.
+        """
+        outcomes = await asyncio.gather(*(self._execute(tool_use) for tool_use in tool_uses))
+        results = [result for result, _ in outcomes]
+        trace = [entry for _, entry in outcomes]
+        return results, trace
+
+    async def _execute(self, tool_use):
+        name = tool_use["name"]
+        tool_input = tool_use.get("input") or {}
+        start_time = time.perf_counter()
+        entry = {"id": tool_use["id"], "name": name, "cached": False, "error": None}
+
+        try:
+            tool = self._tools.get(name)
+            if tool is None:
+                raise LookupError(f"Unknown tool: {name}")
+
+            if tool["cacheable"]:
+                version = tool["version"](tool_input) if tool["version"] is not None else None
+                key = (name, json.dumps(tool_input, sort_keys=True, ensure_ascii=False), version)
+                output = self._get_cached(key)
+                if output is not None:
+                    entry["cached"] = True
+                else:
+                    task = self._pending.get(key)
+                    if task is None:
+                        task = asyncio.ensure_future(self._call(tool, tool_input, key))
+                        self._pending[key] = task
+                        task.add_done_callback(lambda _, key=key: self._pending.pop(key, None))
+                    # Shield the shared task so one caller's timeout does not cancel it for others
+                    output = await asyncio.wait_for(asyncio.shield(task), timeout=tool["timeout"])
+            else:
+                output = await asyncio.wait_for(self._call(tool, tool_input), timeout=tool["timeout"])
+
+            result = {"type": "tool_result", "tool_use_id": tool_use["id"], "content": output}
+        except asyncio.TimeoutError:
+            entry["error"] = f"Tool {name} timed out"
+            result = {"type": "tool_result", "tool_use_id": tool_use["id"],
+                      "content": entry["error"], "is_error": True}
+        except Exception as error:
+            print(f"Error executing tool {name}: {error}")
+            entry["error"] = str(error)
+            result = {"type": "tool_result", "tool_use_id": tool_use["id"],
+                      "content": entry["error"], "is_error": True}
+
+        entry["latencyMs"] = round((time.perf_counter() - start_time) * 1000, 3)
+        return result, entry
+
+    async def _call(self, tool, tool_input, key=None):
+        handler = tool["handler"]
+        if inspect.iscoroutinefunction(handler):
+            output = await handler(tool_input)
+        else:
+            # Synchronous handlers run in a worker thread so calls overlap
+            output = await asyncio.to_thread(handler, tool_input)
+        if not isinstance(output, str):
+            output = json.dumps(output, ensure_ascii=False)
+        if key is not None:
+            self._put_cached(key, output)
+        return output
+
+    def _get_cached(self, key):
+        cached = self._cache.get(key)
+        if cached is None:
+            return None
+        expires_at, output = cached
+        if expires_at < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return output
+
+    def _put_cached(self, key, output):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, output)
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+
+def price_version(tool_input):
+    """Price store state for the tool's symbols; changes when prices are added or cleared"""
+    return price_store.generation, tuple(price_store.get_length(symbol) for symbol in tool_input.get("symbols", []))
+
+
+async def run_indicator_tool(tool_input):
+    """
+    Run the indicator tool on the event loop. The tick and price endpoints
+    update the same engine there, and its slot arrays are not thread-safe.
+    """
+    return indicator_engine.run_tool(tool_input)
+
+
+def create_default_registry():
+    """Registry with the built-in market data tools"""
+    registry = ToolRegistry()
+    # Optimizer results are cached until new prices arrive for any of the symbols
+    registry.register(PORTFOLIO_TOOL, portfolio_optimizer.run_tool, timeout=5.0, version=price_version)
+    # Live indicators change with every tick, so their results are never cached
+    registry.register(INDICATOR_TOOL, run_indicator_tool, timeout=2.0, cacheable=False)
+    return registry
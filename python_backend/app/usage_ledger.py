@@ -0,0 +1,314 @@
+import asyncio
+import math
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Key
+from app.dynamodb_client import dynamodb
+
+# USD per million input / output tokens
+MODEL_PRICING = {
+    "us.anthropic.claude-3-7-sonnet-20250219-v1:0": (3.0, 15.0)
+}
+
+# Partition key prefix of the per-day aggregate items, next to the session partitions
+DAILY_KEY_PREFIX = "#daily#"
+
+class TokenBudgetExceeded(Exception):
+    """Raised before a Bedrock call when it would exceed a token budget"""
+
+class UsageLedger:
+    """
+    Token usage per call, turn, session and model.
+
+    Totals are aggregated in memory and the per-call records are written to
+    DynamoDB in batches, every `flush_interval` seconds or once
+    `flush_batch_size` records are pending. Each flush also adds the day's
+    new tokens to a per-day aggregate item, which is read back on startup
+    so the global daily budget survives restarts. Per-session and global daily
+    budgets are checked before each Bedrock call, and the tokens the call
+    may use are reserved until its actual usage is recorded, so concurrent
+    calls cannot overrun a budget together.
+    """
+
+    def __init__(self, session_budget=None, global_daily_budget=None, flush_interval=30,
+                 flush_batch_size=100, min_output_tokens=256, max_pending=10000):
+        self.table_name = "DeepValueTokenUsage"
+        self.table = dynamodb.Table(self.table_name)
+
+        # Budgets in input + output tokens; 0 or unset disables a budget
+        self.session_budget = session_budget if session_budget is not None else int(os.getenv("SESSION_TOKEN_BUDGET", 0))
+        self.global_daily_budget = (global_daily_budget if global_daily_budget is not None
+                                    else int(os.getenv("GLOBAL_DAILY_TOKEN_BUDGET", 0)))
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.min_output_tokens = min_output_tokens
+        self.max_pending = max_pending
+
+        self._sessions = {}
+        self._models = {}
+        self._total = self._empty_totals()
+        self._day = self._today()
+        self._day_tokens = 0
+        # Day whose stored total has been read into _day_tokens
+        self._loaded_day = None
+        # day -> totals recorded since the last flush of the daily aggregates
+        self._unflushed_days = {}
+
+        # Tokens reserved by calls in flight, per session and for today
+        self._reserved_sessions = {}
+        self._reserved_day = 0
+
+        # Sessions whose earlier usage has been read back from DynamoDB
+        self._loaded_sessions = set()
+        self._pending = []
+        self._flush_task = None
+
+    @staticmethod
+    def estimate_tokens(text):
+        """Rough, deliberately high token estimate for a request body (about 4 characters per token)"""
+        return math.ceil(len(text) / 4)
+
+    async def reserve(self, session_id, estimated_input_tokens, max_tokens):
+        """
+        Check the budgets before a Bedrock call and reserve the tokens it may
+        use. Returns a reservation whose "maxTokens" is the max_tokens to
+        request, lowered so the call cannot overrun the remaining budget.
+        Raises TokenBudgetExceeded when too little budget is left.
+
+        Pass the reservation to `record` once the call returns, or to
+        `release` if it fails.
+        """
+        if self.session_budget and session_id and session_id not in self._loaded_sessions:
+            await self._load_session(session_id)
+        self._roll_day()
+        if self.global_daily_budget and self._loaded_day != self._day:
+            await self._load_day()
+
+        remaining = []
+        if self.session_budget and session_id:
+            used = self._totals_for(self._sessions, session_id)
+            remaining.append(("session", self.session_budget - used["inputTokens"] - used["outputTokens"]
+                              - self._reserved_sessions.get(session_id, 0)))
+        if self.global_daily_budget:
+            remaining.append(("global daily", self.global_daily_budget - self._day_tokens - self._reserved_day))
+
+        allowed = max_tokens
+        for name, left in remaining:
+            output_room = left - estimated_input_tokens
+            if output_room < self.min_output_tokens:
+                raise TokenBudgetExceeded(f"The {name} token budget has been exhausted")
+            allowed = min(allowed, output_room)
+
+        tokens = estimated_input_tokens + allowed
+        self._reserved_sessions[session_id] = self._reserved_sessions.get(session_id, 0) + tokens
+        self._reserved_day += tokens
+        return {"sessionId": session_id, "day": self._day, "tokens": tokens, "maxTokens": allowed}
+
+    def release(self, reservation):
+        """Return the tokens of a reservation to the budgets; safe to call more than once"""
+        if reservation is None or reservation["tokens"] == 0:
+            return
+        session_id = reservation["sessionId"]
+        left = self._reserved_sessions.get(session_id, 0) - reservation["tokens"]
+        if left > 0:
+            self._reserved_sessions[session_id] = left
+        else:
+            self._reserved_sessions.pop(session_id, None)
+        if reservation["day"] == self._day:
+            self._reserved_day = max(0, self._reserved_day - reservation["tokens"])
+        reservation["tokens"] = 0
+
+    async def record(self, session_id, model_id, usage, reservation=None, turn_id=None, round_number=1):
+        """
+        Record the usage returned for one Bedrock call, settling its
+        reservation. `turn_id` groups the calls of one user turn, whose tool
+        rounds are numbered from 1.
+        """
+        input_tokens = int(usage.get("input_tokens", 0))
+        output_tokens = int(usage.get("output_tokens", 0))
+        self.release(reservation)
+        self._roll_day()
+
+        for totals in (self._total, self._totals_for(self._sessions, session_id),
+                       self._totals_for(self._models, model_id),
+                       self._totals_for(self._unflushed_days, self._day)):
+            totals["inputTokens"] += input_tokens
+            totals["outputTokens"] += output_tokens
+            totals["calls"] += 1
+            totals["turns"] += 1 if round_number == 1 else 0
+        self._day_tokens += input_tokens + output_tokens
+
+        self._pending.append({
+            "sessionId": session_id or "anonymous",
+            "usageId": f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}",
+            "turnId": turn_id or f"turn_{uuid.uuid4().hex}",
+            "round": round_number,
+            "date": self._day,
+            "modelId": model_id,
+            "inputTokens": input_tokens,
+            "outputTokens": output_tokens
+        })
+        if len(self._pending) >= self.flush_batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Write pending usage records in one batch and add them to the daily aggregates"""
+        items, self._pending = self._pending, []
+        days, self._unflushed_days = self._unflushed_days, {}
+
+        if items:
+            try:
+                with self.table.batch_writer() as batch:
+                    for item in items:
+                        batch.put_item(Item=item)
+            except Exception as error:
+                await self._handle_error(error, f"flushing {len(items)} usage records")
+                # Keep the records for the next flush, dropping the oldest if storage stays unavailable
+                self._pending = (items + self._pending)[-self.max_pending:]
+
+        for day, totals in days.items():
+            try:
+                # ADD is atomic, so several server processes can share the daily total
+                self.table.update_item(
+                    Key={"sessionId": f"{DAILY_KEY_PREFIX}{day}", "usageId": "total"},
+                    UpdateExpression="ADD inputTokens :input, outputTokens :output, calls :calls, turns :turns",
+                    ExpressionAttributeValues={
+                        ":input": totals["inputTokens"], ":output": totals["outputTokens"],
+                        ":calls": totals["calls"], ":turns": totals["turns"]
+                    }
+                )
+            except Exception as error:
+                await self._handle_error(error, f"updating the usage total for {day}")
+                unflushed = self._totals_for(self._unflushed_days, day)
+                for key, value in totals.items():
+                    unflushed[key] += value
+
+    async def start(self):
+        """Load today's stored usage and start the periodic flush loop"""
+        await self._load_day()
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop the flush loop and write out anything pending"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def get_summary(self, session_id=None):
+        """Usage totals and estimated cost for capacity planning"""
+        self._roll_day()
+        summary = {
+            "total": self._with_cost(self._total),
+            "today": {"date": self._day, "tokens": self._day_tokens, "reserved": self._reserved_day},
+            "models": {model_id: self._with_cost(totals, model_id) for model_id, totals in self._models.items()},
+            "sessions": len(self._sessions),
+            "budgets": {
+                "session": self.session_budget or None,
+                "globalDaily": self.global_daily_budget or None
+            },
+            "pendingRecords": len(self._pending)
+        }
+        if session_id is not None:
+            totals = self._sessions.get(session_id, self._empty_totals())
+            summary["session"] = dict(totals, sessionId=session_id)
+        return summary
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _load_session(self, session_id):
+        """Add usage recorded for a session before this process started"""
+        try:
+            stored = self._empty_totals()
+            query = {"KeyConditionExpression": Key("sessionId").eq(session_id)}
+            while True:
+                response = self.table.query(**query)
+                for item in response.get("Items", []):
+                    stored["inputTokens"] += int(item.get("inputTokens", 0))
+                    stored["outputTokens"] += int(item.get("outputTokens", 0))
+                    stored["calls"] += 1
+                    stored["turns"] += 1 if int(item.get("round", 1)) == 1 else 0
+                if "LastEvaluatedKey" not in response:
+                    break
+                query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+            # Another call may have loaded the session meanwhile
+            if session_id not in self._loaded_sessions:
+                totals = self._totals_for(self._sessions, session_id)
+                for key, value in stored.items():
+                    totals[key] += value
+                self._loaded_sessions.add(session_id)
+        except Exception as error:
+            if await self._handle_error(error, f"loading usage for session {session_id}"):
+                self._loaded_sessions.add(session_id)
+
+    async def _load_day(self):
+        """Set today's total from the stored daily aggregate plus what has not been flushed yet"""
+        day = self._day
+        try:
+            item = self.table.get_item(Key={"sessionId": f"{DAILY_KEY_PREFIX}{day}", "usageId": "total"}).get("Item", {})
+        except Exception as error:
+            if await self._handle_error(error, f"loading the usage total for {day}"):
+                self._loaded_day = day
+            return
+        if day == self._day:
+            unflushed = self._unflushed_days.get(day, self._empty_totals())
+            self._day_tokens = (int(item.get("inputTokens", 0)) + int(item.get("outputTokens", 0))
+                                + unflushed["inputTokens"] + unflushed["outputTokens"])
+            self._loaded_day = day
+
+    async def _handle_error(self, error, action):
+        """Log a storage error; returns True when the usage table does not exist"""
+        print(f"Error {action}: {error}")
+        if hasattr(error, "response") and error.response.get("Error", {}).get("Code") == "ResourceNotFoundException":
+            await self._create_usage_table()
+            return True
+        return False
+
+    def _with_cost(self, totals, model_id=None):
+        """Totals with an estimated USD cost; without a model, the sum over all priced models"""
+        if model_id is None:
+            cost = sum(self._cost(model_totals, model) for model, model_totals in self._models.items())
+        else:
+            cost = self._cost(totals, model_id)
+        return dict(totals, estimatedCostUsd=round(cost, 4))
+
+    @staticmethod
+    def _cost(totals, model_id):
+        input_price, output_price = MODEL_PRICING.get(model_id, (0.0, 0.0))
+        return (totals["inputTokens"] * input_price + totals["outputTokens"] * output_price) / 1e6
+
+    def _roll_day(self):
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self._day_tokens = 0
+            self._reserved_day = 0
+
+    @staticmethod
+    def _today():
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    @staticmethod
+    def _empty_totals():
+        return {"inputTokens": 0, "outputTokens": 0, "calls": 0, "turns": 0}
+
+    def _totals_for(self, table, key):
+        totals = table.get(key)
+        if totals is None:
+            totals = table[key] = self._empty_totals()
+        return totals
+
+    # Helper method to create the table if it doesn't exist
+    async def _create_usage_table(self):
+        print("Creating usage table...")
+        # This would normally use boto3 to create the table
+        # But for now, we'll just log the error since we don't have permissions
+        print("Please create the DeepValueTokenUsage table manually with sessionId (String) as the partition key and usageId (String) as the sort key")
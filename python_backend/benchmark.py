@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Benchmark script for DeepValue Python Backend compute engines
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app.market_data import PriceStore
+from app.portfolio_optimizer import PortfolioOptimizer
+from app import indicators
+from app.indicators import IndicatorEngine
+from app.retrieval import SearchIndex
+
+# Configuration
+ASSET_COUNTS = [10, 50, 100, 250, 500]
+HISTORY_LENGTH = 1000
+REPEATS = 5
+SYMBOL_COUNTS = [100, 1000, 5000]
+TICK_ROUNDS = 200
+SERIES_LENGTH = 100000
+PASSAGE_COUNT = int(os.getenv("BENCH_PASSAGES", 1000000))
+QUERY_COUNT = 500
+
+def timed(func, repeats=REPEATS):
+    """Return the best wall-clock time of several runs, in milliseconds"""
+    best = float("inf")
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start_time)
+    return best * 1000
+
+def make_price_store(n_assets, n_prices, seed=0):
+    """Fill a PriceStore with synthetic one-factor price paths"""
+    rng = np.random.default_rng(seed)
+    market = rng.normal(0.0003, 0.01, size=n_prices)
+    betas = rng.uniform(0.5, 1.5, size=n_assets)
+    noise = rng.normal(0.0, 0.015, size=(n_prices, n_assets))
+    returns = market[:, None] * betas + noise
+    prices = 100.0 * np.cumprod(1.0 + returns, axis=0)
+
+    store = PriceStore()
+    symbols = [f"SYM{i:04d}" for i in range(n_assets)]
+    for column, symbol in enumerate(symbols):
+        store.add_prices(symbol, prices[:, column])
+    return store, symbols, rng
+
+def benchmark_portfolio_optimizer():
+    """Benchmark covariance estimation and optimization across asset counts"""
+    print("\n=== Benchmarking portfolio optimizer ===")
+    print(f"{'assets':>8} {'cov cold':>10} {'cov incr':>10} {'mean-var':>10} {'min-var':>10} {'risk-par':>10}  (ms)")
+
+    for n_assets in ASSET_COUNTS:
+        store, symbols, rng = make_price_store(n_assets, HISTORY_LENGTH)
+
+        def cold_covariance():
+            PortfolioOptimizer(store).get_covariance(symbols, lookback=252)
+
+        optimizer = PortfolioOptimizer(store)
+        optimizer.get_covariance(symbols, lookback=252)
+
+        def incremental_covariance():
+            for symbol in symbols:
+                store.add_prices(symbol, store.get_prices(symbol)[-1] * (1.0 + rng.normal(0.0, 0.01)))
+            optimizer.get_covariance(symbols, lookback=252)
+
+        row = [
+            timed(cold_covariance),
+            timed(incremental_covariance),
+            timed(lambda: optimizer.optimize(symbols, "mean_variance", lookback=252, max_weight=0.1)),
+            timed(lambda: optimizer.optimize(symbols, "min_variance", lookback=252, max_weight=0.1)),
+            timed(lambda: optimizer.optimize(symbols, "risk_parity", lookback=252))
+        ]
+        print(f"{n_assets:>8} " + " ".join(f"{value:>10.2f}" for value in row))
+
+def benchmark_indicators():
+    """Benchmark batch indicator computation and streaming tick throughput"""
+    print("\n=== Benchmarking technical indicators ===")
+    rng = np.random.default_rng(0)
+    closes = 100.0 * np.cumprod(1.0 + rng.normal(0.0, 0.01, size=SERIES_LENGTH))
+
+    def batch_all():
+        indicators.sma(closes, 20)
+        indicators.ema(closes, 20)
+        indicators.rsi(closes, 14)
+        indicators.macd(closes)
+        indicators.bollinger_bands(closes)
+        indicators.atr(None, None, closes)
+
+    print(f"Batch, all indicators over {SERIES_LENGTH} closes: {timed(batch_all):.2f} ms")
+
+    engine = IndicatorEngine()
+    single_ticks = closes[:10000]
+    start_time = time.perf_counter()
+    for price in single_ticks:
+        engine.update("SINGLE", price)
+    elapsed = time.perf_counter() - start_time
+    print(f"Streaming, one tick per call: {single_ticks.size / elapsed:,.0f} ticks/s")
+
+    print(f"{'symbols':>8} {'ms/round':>10} {'ticks/s':>14}")
+    for n_symbols in SYMBOL_COUNTS:
+        engine = IndicatorEngine()
+        symbols = [f"SYM{i:05d}" for i in range(n_symbols)]
+        prices = 100.0 * np.cumprod(1.0 + rng.normal(0.0, 0.001, size=(TICK_ROUNDS, n_symbols)), axis=0)
+
+        start_time = time.perf_counter()
+        for row in prices:
+            engine.update_batch(symbols, row)
+        elapsed = time.perf_counter() - start_time
+        print(f"{n_symbols:>8} {elapsed * 1000 / TICK_ROUNDS:>10.3f} {n_symbols * TICK_ROUNDS / elapsed:>14,.0f}")
+
+def make_vocabulary(rng, size=50000):
+    """Synthetic English-like words and Chinese bigrams"""
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    words = ["".join(rng.choice(letters, size=rng.integers(3, 10))) for _ in range(size // 2)]
+    characters = [chr(code) for code in range(0x4e00, 0x4e00 + 3000)]
+    words += ["".join(rng.choice(characters, size=2)) for _ in range(size - len(words))]
+    return np.array(words)
+
+def benchmark_retrieval():
+    """Benchmark BM25 index build, open and query latency, with default and large flush thresholds"""
+    print(f"\n=== Benchmarking retrieval over {PASSAGE_COUNT:,} passages ===")
+    rng = np.random.default_rng(0)
+    vocabulary = make_vocabulary(rng)
+
+    # Zipf-distributed word ranks, as in natural text
+    probabilities = 1.0 / np.arange(1, vocabulary.size + 1)
+    probabilities /= probabilities.sum()
+    rows = vocabulary[rng.choice(vocabulary.size, size=(PASSAGE_COUNT, 40), p=probabilities)]
+    passages = [" ".join(row) for row in rows]
+
+    # Queries mix rare and common terms
+    queries = [
+        " ".join(vocabulary[rng.choice(vocabulary.size, size=rng.integers(2, 5), p=probabilities)])
+        for _ in range(QUERY_COUNT)
+    ]
+
+    for label, options in (("default", {}), ("flush_threshold=100000", {"flush_threshold": 100000})):
+        print(f"\n--- {label} ---")
+        with tempfile.TemporaryDirectory() as directory:
+            index = SearchIndex(directory, **options)
+            start_time = time.perf_counter()
+            batch = 1000
+            for start in range(0, PASSAGE_COUNT, batch):
+                index.add_passages(passages[start:start + batch], "filing", title="benchmark")
+            index.flush()
+            elapsed = time.perf_counter() - start_time
+            print(f"Build: {elapsed:.1f} s ({PASSAGE_COUNT / elapsed:,.0f} passages/s), "
+                  f"segments {index.stats()['segmentSizes']}")
+
+            start_time = time.perf_counter()
+            index = SearchIndex(directory)
+            print(f"Open: {(time.perf_counter() - start_time) * 1000:.2f} ms")
+
+            index.search(queries[0])
+            latencies = []
+            for query in queries:
+                start_time = time.perf_counter()
+                index.search(query, k=5)
+                latencies.append((time.perf_counter() - start_time) * 1000)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            print(f"Query latency: p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms")
+
+def main():
+    """Main function to run all benchmarks"""
+    print("DeepValue Python Backend Benchmarks")
+    print("===================================")
+
+    benchmarks = {
+        "portfolio": benchmark_portfolio_optimizer,
+        "indicators": benchmark_indicators,
+        "retrieval": benchmark_retrieval
+    }
+
+    selected = sys.argv[1:] or list(benchmarks)
+    for name in selected:
+        if name not in benchmarks:
+            print(f"Unknown benchmark: {name} (available: {', '.join(benchmarks)})")
+            sys.exit(1)
+        benchmarks[name]()
+
+    print("\nAll benchmarks completed!")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import os
 import json
 import uuid
-from typing import Optional
+from typing import List, Optional
 from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
@@ -13,6 +13,13 @@ from fastapi.templating import Jinja2Templates
 
 from app.claude_client import ClaudeClient
 from app.chat_history import ChatHistoryService
+from app.market_data import price_store
+from app import indicators
+from app.indicators import indicator_engine
+from app.portfolio_optimizer import portfolio_optimizer
+from app.tools import create_default_registry
+from app.retrieval import search_index
+from app.usage_ledger import TokenBudgetExceeded, UsageLedger
 
 # Load environment variables from .env.aws file
 load_dotenv(dotenv_path='.env.aws')
@@ -29,14 +36,31 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Create Claude client
-claude_client = ClaudeClient()
+# Create usage ledger for token accounting and budgets
+usage_ledger = UsageLedger()
+# Create Claude client with the built-in market data tools
+claude_client = ClaudeClient(tool_registry=create_default_registry(), usage_ledger=usage_ledger)
 # Create chat history service
 chat_history_service = ChatHistoryService()
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# Start the periodic usage flush
+@app.on_event("startup")
+async def start_usage_ledger():
+    await usage_ledger.start()
+
+# Flush buffered search passages to disk on shutdown
+@app.on_event("shutdown")
+async def flush_search_index():
+    search_index.flush()
+
+# Write pending usage records on shutdown
+@app.on_event("shutdown")
+async def flush_usage_ledger():
+    await usage_ledger.stop()
+
 # Define request models
 class ChatRequest(BaseModel):
     message: str
@@ -46,6 +70,34 @@ class ChatRequest(BaseModel):
 class ClearHistoryRequest(BaseModel):
     sessionId: str
 
+class PricesRequest(BaseModel):
+    symbol: str
+    prices: List[float]
+
+class DocumentRequest(BaseModel):
+    text: str
+    title: str = ""
+    source: str = "filing"
+    ref: str = ""
+
+class Tick(BaseModel):
+    symbol: str
+    price: float
+    high: Optional[float] = None
+    low: Optional[float] = None
+
+class TicksRequest(BaseModel):
+    ticks: List[Tick]
+
+class PortfolioOptimizeRequest(BaseModel):
+    symbols: List[str]
+    method: str = "mean_variance"
+    lookback: Optional[int] = None
+    riskAversion: float = 1.0
+    minWeight: float = 0.0
+    maxWeight: float = 1.0
+    riskBudgets: Optional[List[float]] = None
+
 # API endpoint for chat (POST method)
 @app.post("/api/chat")
 async def chat(request: ChatRequest):
@@ -62,8 +114,9 @@ async def chat(request: ChatRequest):
         # Get all messages for the session
         stored_messages = await chat_history_service.get_messages(session_id)
         
-        # Add user message
-        await chat_history_service.add_message(session_id, 'user', request.message)
+        # Retrieve reference passages before the new message is indexed
+        citations = search_index.search(request.message, k=5, session_id=session_id)
+        context = search_index.format_context(citations)
         
         # Format messages for Claude
         claude_messages = [
@@ -72,22 +125,38 @@ async def chat(request: ChatRequest):
         ]
         claude_messages.append({"role": "user", "content": request.message})
         
+        # Refuse the message before storing it if the budget is exhausted
+        await claude_client.check_budget(model_id, claude_messages, context, session_id)
+        
+        # Add user message
+        await chat_history_service.add_message(session_id, 'user', request.message)
+        search_index.add_document(request.message, "chat", title="user", ref=session_id)
+        
         # Get response from Claude
         claude_response = await claude_client.send_message(
             model_id=model_id,
             messages=claude_messages,
-            enable_reasoning=request.enableReasoning
+            enable_reasoning=request.enableReasoning,
+            context=context,
+            session_id=session_id
         )
         
         # Add assistant response
         await chat_history_service.add_message(session_id, 'assistant', claude_response["response"])
+        search_index.add_document(claude_response["response"], "chat", title="assistant", ref=session_id)
         
         # Send response to client
         return {
             "response": claude_response["response"],
             "reasoning": claude_response["reasoning"],
+            "toolTrace": claude_response["toolTrace"],
+            "citations": [_citation_summary(citation) for citation in citations],
+            "usage": claude_response["usage"],
+            "turnId": claude_response["turnId"],
             "sessionId": session_id
         }
+    except TokenBudgetExceeded as error:
+        raise HTTPException(status_code=429, detail=str(error))
     except Exception as error:
         print(f"Error in chat API: {error}")
         
@@ -124,8 +193,16 @@ async def stream_chat(
             # Get all messages for the session
             stored_messages = await chat_history_service.get_messages(current_session_id)
             
-            # Add user message
-            await chat_history_service.add_message(current_session_id, 'user', message)
+            # Retrieve reference passages before the new message is indexed
+            citations = search_index.search(message, k=5, session_id=current_session_id)
+            if citations:
+                yield {
+                    "event": "message",
+                    "data": json.dumps({
+                        "type": "citations",
+                        "citations": [_citation_summary(citation) for citation in citations]
+                    })
+                }
             
             # Format messages for Claude
             claude_messages = [
@@ -133,6 +210,14 @@ async def stream_chat(
                 for msg in stored_messages
             ]
             claude_messages.append({"role": "user", "content": message})
+            context = search_index.format_context(citations)
+            
+            # Refuse the message before storing it if the budget is exhausted
+            await claude_client.check_budget(model_id, claude_messages, context, current_session_id)
+            
+            # Add user message
+            await chat_history_service.add_message(current_session_id, 'user', message)
+            search_index.add_document(message, "chat", title="user", ref=current_session_id)
             
             # Stream response from Claude
             full_response = ""
@@ -140,7 +225,9 @@ async def stream_chat(
             async for chunk in claude_client.stream_message(
                 model_id=model_id,
                 messages=claude_messages,
-                enable_reasoning=enableReasoning
+                enable_reasoning=enableReasoning,
+                context=context,
+                session_id=current_session_id
             ):
                 if chunk["type"] == "thinking":
                     yield {
@@ -152,20 +239,36 @@ async def stream_chat(
                         "event": "message",
                         "data": json.dumps({"type": "content", "content": chunk["content"]})
                     }
+                elif chunk["type"] == "tool_use":
+                    yield {
+                        "event": "message",
+                        "data": json.dumps({"type": "tool_use", "name": chunk["name"], "input": chunk["input"]})
+                    }
+                elif chunk["type"] == "tool_result":
+                    yield {
+                        "event": "message",
+                        "data": json.dumps({"type": "tool_result", "trace": chunk["trace"]})
+                    }
                 elif chunk["type"] == "done":
                     # Save the full response to DynamoDB
                     await chat_history_service.add_message(current_session_id, 'assistant', chunk["content"])
+                    search_index.add_document(chunk["content"], "chat", title="assistant", ref=current_session_id)
                     
                     # Send done event
                     yield {
                         "event": "message",
-                        "data": json.dumps({"type": "done"})
+                        "data": json.dumps({"type": "done", "usage": chunk["usage"], "turnId": chunk["turnId"]})
                     }
                 elif chunk["type"] == "error":
                     yield {
                         "event": "message",
                         "data": json.dumps({"type": "error", "error": chunk["error"]})
                     }
+        except TokenBudgetExceeded as error:
+            yield {
+                "event": "message",
+                "data": json.dumps({"type": "error", "error": str(error)})
+            }
         except Exception as error:
             print(f"Error in streaming chat API: {error}")
             yield {
@@ -206,6 +309,7 @@ async def clear_history(request: ClearHistoryRequest):
         
         # Clear session messages but keep the same session ID
         cleared_session_id = await chat_history_service.clear_session(request.sessionId)
+        search_index.clear_session(request.sessionId)
         
         return {
             "success": True,
@@ -218,6 +322,215 @@ async def clear_history(request: ClearHistoryRequest):
             detail="Failed to clear chat history. Please try again."
         )
 
+def _citation_summary(result):
+    return {
+        "citation": result["citation"],
+        "title": result["title"],
+        "source": result["source"],
+        "ref": result["ref"],
+        "score": result["score"]
+    }
+
+# API endpoint to ingest a filing or report into the search index
+@app.post("/api/documents")
+async def add_document(request: DocumentRequest):
+    try:
+        if request.source == "chat":
+            raise ValueError("The chat source is reserved for session messages")
+        
+        passage_ids = search_index.add_document(request.text, request.source, request.title, request.ref)
+        
+        return {
+            "success": True,
+            "citations": [f"P{passage_id}" for passage_id in passage_ids]
+        }
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        print(f"Error indexing document: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to index document. Please try again."
+        )
+
+# API endpoint to search indexed filings, reports and session messages
+@app.get("/api/search")
+async def search(q: str, k: int = 5, sessionId: Optional[str] = None):
+    try:
+        results = search_index.search(q, k=k, session_id=sessionId)
+        
+        return {
+            "success": True,
+            "results": results,
+            "stats": search_index.stats()
+        }
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        print(f"Error searching index: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to search. Please try again."
+        )
+
+# API endpoint for token usage totals and budgets
+@app.get("/api/usage")
+async def get_usage(sessionId: Optional[str] = None):
+    try:
+        return {
+            "success": True,
+            "usage": usage_ledger.get_summary(sessionId)
+        }
+    except Exception as error:
+        print(f"Error getting usage: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to get usage. Please try again."
+        )
+
+# API endpoint to append close prices to the local data store
+@app.post("/api/market/prices")
+async def add_prices(request: PricesRequest):
+    try:
+        length = price_store.add_prices(request.symbol, request.prices)
+        
+        # Keep live indicators in step with the stored closes
+        if indicator_engine.is_tracked(request.symbol):
+            for price in request.prices:
+                indicator_engine.update(request.symbol, price)
+        
+        return {
+            "success": True,
+            "symbol": request.symbol,
+            "length": length
+        }
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        print(f"Error adding prices: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to store prices. Please try again."
+        )
+
+# API endpoint to stream ticks into the indicator engine
+@app.post("/api/market/ticks")
+async def add_ticks(request: TicksRequest):
+    try:
+        symbols = [tick.symbol for tick in request.ticks]
+        
+        # Seed new symbols from stored closes before applying live ticks
+        indicator_engine.ensure_loaded(set(symbols))
+        indicator_engine.update_batch(
+            symbols,
+            [tick.price for tick in request.ticks],
+            [tick.high if tick.high is not None else tick.price for tick in request.ticks],
+            [tick.low if tick.low is not None else tick.price for tick in request.ticks]
+        )
+        
+        return {
+            "success": True,
+            "count": len(request.ticks)
+        }
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        print(f"Error adding ticks: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to process ticks. Please try again."
+        )
+
+# API endpoint to fetch the latest indicators for one or more symbols
+@app.get("/api/indicators")
+async def get_indicators(symbols: str):
+    try:
+        symbol_list = [symbol.strip() for symbol in symbols.split(",") if symbol.strip()]
+        indicator_engine.ensure_loaded(symbol_list)
+        
+        return {
+            "success": True,
+            "indicators": [indicator_engine.snapshot(symbol) for symbol in symbol_list],
+            "summary": "\n".join(indicator_engine.summary(symbol) for symbol in symbol_list)
+        }
+    except Exception as error:
+        print(f"Error fetching indicators: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to fetch indicators. Please try again."
+        )
+
+# API endpoint to compute indicator series over a symbol's stored close history
+@app.get("/api/indicators/series")
+async def get_indicator_series(symbol: str, limit: int = 200):
+    try:
+        if limit < 1:
+            raise HTTPException(status_code=400, detail="limit must be at least 1")
+        closes = price_store.get_prices(symbol)
+        if closes.size == 0:
+            raise HTTPException(status_code=404, detail=f"No price history for {symbol}")
+        
+        engine = indicator_engine
+        sma = indicators.sma(closes, engine.sma_period)
+        ema = indicators.ema(closes, engine.ema_period)
+        rsi = indicators.rsi(closes, engine.rsi_period)
+        macd_line, macd_signal, macd_histogram = indicators.macd(
+            closes, engine.macd_fast, engine.macd_slow, engine.macd_signal)
+        middle, upper, lower = indicators.bollinger_bands(
+            closes, engine.bollinger_period, engine.bollinger_width)
+        atr = indicators.atr(None, None, closes, engine.atr_period)
+        
+        def tail(values):
+            # JSON has no NaN: report warm-up values as null
+            return [None if value != value else value for value in values[-limit:].tolist()]
+        
+        return {
+            "success": True,
+            "symbol": symbol,
+            "close": tail(closes),
+            "sma": tail(sma),
+            "ema": tail(ema),
+            "rsi": tail(rsi),
+            "macd": {"line": tail(macd_line), "signal": tail(macd_signal), "histogram": tail(macd_histogram)},
+            "bollinger": {"middle": tail(middle), "upper": tail(upper), "lower": tail(lower)},
+            "atr": tail(atr)
+        }
+    except HTTPException:
+        raise
+    except Exception as error:
+        print(f"Error computing indicator series: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to compute indicators. Please try again."
+        )
+
+# API endpoint for portfolio optimization
+@app.post("/api/portfolio/optimize")
+async def optimize_portfolio(request: PortfolioOptimizeRequest):
+    try:
+        result = portfolio_optimizer.optimize(
+            symbols=request.symbols,
+            method=request.method,
+            lookback=request.lookback,
+            risk_aversion=request.riskAversion,
+            min_weight=request.minWeight,
+            max_weight=request.maxWeight,
+            risk_budgets=request.riskBudgets
+        )
+        
+        return {
+            "success": True,
+            **result
+        }
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except Exception as error:
+        print(f"Error optimizing portfolio: {error}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to optimize portfolio. Please try again."
+        )
+
 # Root endpoint
 @app.get("/", response_class=HTMLResponse)
 async def root():
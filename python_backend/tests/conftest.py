@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# Import the app package from python_backend, and keep the module-level search
+# index out of data/ while the tests run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SEARCH_INDEX_DIR", tempfile.mkdtemp(prefix="deepvalue-tests-"))
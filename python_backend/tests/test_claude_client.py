@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+from app.claude_client import FINAL_ROUND_PROMPT, MAX_TOOL_ROUNDS, TOOL_LIMIT_NOTICE, ClaudeClient
+from app.tools import ToolRegistry
+
+MODEL_ID = "test-model"
+
+ECHO_TOOL = {
+    "name": "echo",
+    "description": "Echo the input",
+    "input_schema": {"type": "object", "properties": {}}
+}
+
+
+class FakeRuntime:
+    """Bedrock runtime stand-in that replays scripted streams and records request bodies"""
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.bodies = []
+
+    def invoke_model_with_response_stream(self, **params):
+        self.bodies.append(json.loads(params["body"]))
+        events = self.streams.pop(0) if len(self.streams) > 1 else self.streams[0]
+        return {"body": [{"chunk": {"bytes": json.dumps(event).encode()}} for event in events]}
+
+
+def text_block(index, *fragments):
+    return [{"type": "content_block_start", "index": index, "content_block": {"type": "text", "text": ""}}] + [
+        {"type": "content_block_delta", "index": index, "delta": {"type": "text_delta", "text": fragment}}
+        for fragment in fragments
+    ] + [{"type": "content_block_stop", "index": index}]
+
+
+def tool_block(index, tool_id, *fragments):
+    return [{"type": "content_block_start", "index": index,
+             "content_block": {"type": "tool_use", "id": tool_id, "name": "echo", "input": {}}}] + [
+        {"type": "content_block_delta", "index": index, "delta": {"type": "input_json_delta", "partial_json": fragment}}
+        for fragment in fragments
+    ] + [{"type": "content_block_stop", "index": index}]
+
+
+def message(blocks, stop_reason, input_tokens=10, output_tokens=5):
+    return ([{"type": "message_start", "message": {"usage": {"input_tokens": input_tokens, "output_tokens": 1}}}]
+            + blocks
+            + [{"type": "message_delta", "delta": {"stop_reason": stop_reason}, "usage": {"output_tokens": output_tokens}},
+               {"type": "message_stop"}])
+
+
+def make_client(streams):
+    calls = []
+
+    async def echo(tool_input):
+        calls.append(tool_input)
+        return {"echo": tool_input}
+
+    registry = ToolRegistry()
+    registry.register(ECHO_TOOL, echo, cacheable=False)
+    client = ClaudeClient(tool_registry=registry)
+    client.bedrock_runtime = FakeRuntime(streams)
+    return client, calls
+
+
+def stream(client, **kwargs):
+    async def collect():
+        return [chunk async for chunk in client.stream_message(
+            MODEL_ID, [{"role": "user", "content": "hi"}], **kwargs)]
+    return asyncio.run(collect())
+
+
+def test_stream_assembles_tool_input_from_json_deltas():
+    client, calls = make_client([
+        message(text_block(0, "Let me ", "check.")
+                + tool_block(1, "tool_1", '{"symbols": ["A', 'AA", "BBB"]', ', "limit": 2}')
+                + tool_block(2, "tool_2"), "tool_use"),
+        message(text_block(0, "Done."), "end_turn")
+    ])
+    chunks = stream(client)
+
+    assert calls == [{"symbols": ["AAA", "BBB"], "limit": 2}, {}]
+    assert [(chunk["id"], chunk["input"]) for chunk in chunks if chunk["type"] == "tool_use"] == [
+        ("tool_1", {"symbols": ["AAA", "BBB"], "limit": 2}), ("tool_2", {})
+    ]
+    assert chunks[-1]["type"] == "done"
+    assert chunks[-1]["content"] == "Let me check.\n\nDone."
+
+    # The second request replays the assistant turn and answers each tool_use in order
+    assistant, tool_results = client.bedrock_runtime.bodies[1]["messages"][-2:]
+    assert assistant == {"role": "assistant", "content": [
+        {"type": "text", "text": "Let me check."},
+        {"type": "tool_use", "id": "tool_1", "name": "echo", "input": {"symbols": ["AAA", "BBB"], "limit": 2}},
+        {"type": "tool_use", "id": "tool_2", "name": "echo", "input": {}}
+    ]}
+    assert tool_results["role"] == "user"
+    assert [block["tool_use_id"] for block in tool_results["content"]] == ["tool_1", "tool_2"]
+    assert json.loads(tool_results["content"][0]["content"]) == {"echo": {"symbols": ["AAA", "BBB"], "limit": 2}}
+
+
+def test_final_round_disallows_tools_and_adds_notice():
+    client, calls = make_client([message(tool_block(0, "tool_1", "{}"), "tool_use")])
+    chunks = stream(client)
+
+    bodies = client.bedrock_runtime.bodies
+    assert len(bodies) == MAX_TOOL_ROUNDS + 1
+    assert len(calls) == MAX_TOOL_ROUNDS
+    assert all(FINAL_ROUND_PROMPT not in body["system"] for body in bodies[:-1])
+    assert bodies[-1]["system"].endswith(FINAL_ROUND_PROMPT)
+    assert chunks[-1]["type"] == "done"
+    assert chunks[-1]["content"].endswith(TOOL_LIMIT_NOTICE)
+
+
+def test_tool_cache_follows_data_version():
+    version = {"value": 0}
+    calls = []
+
+    def handler(tool_input):
+        calls.append(tool_input)
+        return f"result {version['value']}"
+
+    registry = ToolRegistry()
+    registry.register(ECHO_TOOL, handler, version=lambda tool_input: version["value"])
+    tool_use = {"type": "tool_use", "id": "tool_1", "name": "echo", "input": {"symbols": ["AAA"]}}
+
+    async def run():
+        results, trace = await registry.execute_all([tool_use])
+        return results[0]["content"], trace[0]["cached"]
+
+    assert asyncio.run(run()) == ("result 0", False)
+    assert asyncio.run(run()) == ("result 0", True)
+    version["value"] = 1
+    assert asyncio.run(run()) == ("result 1", False)
+    assert len(calls) == 2
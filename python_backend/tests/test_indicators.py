@@ -0,0 +1,131 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from app.indicators import IndicatorEngine, atr, bollinger_bands, ema, macd, rsi, sma
+from app.market_data import PriceStore
+
+
+def make_bars(n_prices=320, seed=0):
+    rng = np.random.default_rng(seed)
+    closes = 100.0 * np.cumprod(1.0 + rng.normal(0.0, 0.02, n_prices))
+    highs = closes * (1.0 + rng.uniform(0.0, 0.01, n_prices))
+    lows = closes * (1.0 - rng.uniform(0.0, 0.01, n_prices))
+    return closes, highs, lows
+
+
+def expected_snapshot(closes, highs, lows, index):
+    """Batch indicator values at `index`, shaped like IndicatorEngine.snapshot"""
+    def value(series):
+        return None if np.isnan(series[index]) else float(series[index])
+
+    line, signal, histogram = macd(closes)
+    middle, upper, lower = bollinger_bands(closes)
+    return {
+        "price": float(closes[index]),
+        "count": index + 1,
+        "sma": value(sma(closes, 20)),
+        "ema": value(ema(closes, 20)),
+        "rsi": value(rsi(closes)),
+        "macd": None if np.isnan(line[index]) else {
+            "line": value(line), "signal": value(signal), "histogram": value(histogram)
+        },
+        "bollinger": None if np.isnan(middle[index]) else {
+            "middle": value(middle), "upper": value(upper), "lower": value(lower)
+        },
+        "atr": value(atr(highs, lows, closes))
+    }
+
+
+def assert_matches(snapshot, expected):
+    for key, value in expected.items():
+        if isinstance(value, dict):
+            assert snapshot[key] is not None, key
+            for name, number in value.items():
+                assert snapshot[key][name] == pytest.approx(number, rel=1e-9, abs=1e-9), (key, name)
+        else:
+            assert snapshot[key] == pytest.approx(value, rel=1e-9, abs=1e-9), key
+
+
+CHECKPOINTS = (0, 1, 13, 14, 19, 25, 33, 34, 100, 255, 256, 319)
+
+
+def test_streaming_updates_match_batch_indicators():
+    closes, highs, lows = make_bars()
+    engine = IndicatorEngine(store=PriceStore())
+    for index in range(closes.size):
+        engine.update("AAA", closes[index], highs[index], lows[index])
+        if index in CHECKPOINTS:
+            assert_matches(engine.snapshot("AAA"), expected_snapshot(closes, highs, lows, index))
+
+
+def test_batch_updates_match_batch_indicators():
+    bars = [make_bars(seed=seed) for seed in range(3)]
+    symbols = ["AAA", "BBB", "CCC"]
+    engine = IndicatorEngine(store=PriceStore(), initial_symbols=2)
+
+    # Two bars per symbol per batch, so every batch repeats each symbol
+    for start in range(0, bars[0][0].size, 2):
+        batch_symbols, prices, batch_highs, batch_lows = [], [], [], []
+        for offset in (0, 1):
+            for symbol, (closes, highs, lows) in zip(symbols, bars):
+                batch_symbols.append(symbol)
+                prices.append(closes[start + offset])
+                batch_highs.append(highs[start + offset])
+                batch_lows.append(lows[start + offset])
+        engine.update_batch(batch_symbols, prices, batch_highs, batch_lows)
+        index = start + 1
+        if index in CHECKPOINTS or index - 1 in CHECKPOINTS:
+            for symbol, (closes, highs, lows) in zip(symbols, bars):
+                assert_matches(engine.snapshot(symbol), expected_snapshot(closes, highs, lows, index))
+
+
+@pytest.mark.parametrize("size", [1, 14, 15, 26, 34, 300])
+def test_load_history_matches_streaming(size):
+    closes, highs, lows = make_bars()
+    streamed = IndicatorEngine(store=PriceStore())
+    for index in range(size):
+        streamed.update("AAA", closes[index], highs[index], lows[index])
+    loaded = IndicatorEngine(store=PriceStore())
+    loaded.load_history("AAA", closes[:size], highs[:size], lows[:size])
+
+    assert_matches(loaded.snapshot("AAA"), expected_snapshot(closes, highs, lows, size - 1))
+    assert np.array_equal(loaded.get_closes("AAA"), streamed.get_closes("AAA"))
+
+    # A seeded symbol keeps streaming from where its history ended
+    for index in range(size, size + 20):
+        streamed.update("AAA", closes[index], highs[index], lows[index])
+        loaded.update("AAA", closes[index], highs[index], lows[index])
+    snapshot = loaded.snapshot("AAA")
+    assert_matches(snapshot, {key: value for key, value in streamed.snapshot("AAA").items() if key != "symbol"})
+    assert_matches(snapshot, expected_snapshot(closes, highs, lows, size + 19))
+
+
+@pytest.mark.parametrize("high, low", [
+    (float("nan"), 9.0), (11.0, float("nan")), (float("inf"), 9.0), (11.0, float("-inf")),
+    (9.0, 11.0), (9.5, 9.0), (11.0, 10.5)
+])
+def test_invalid_highs_and_lows_are_rejected(high, low):
+    engine = IndicatorEngine(store=PriceStore())
+    engine.update("AAA", 10.0, 10.5, 9.5)
+    before = engine.snapshot("AAA")
+
+    with pytest.raises(ValueError):
+        engine.update("AAA", 10.0, high, low)
+    with pytest.raises(ValueError):
+        engine.update_batch(["AAA", "BBB"], [10.0, 10.0], [10.5, high], [9.5, low])
+
+    # A rejected batch leaves every symbol untouched
+    assert engine.snapshot("AAA") == before
+    assert not engine.is_tracked("BBB")
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_indicator_series_rejects_non_positive_limit(limit):
+    import main
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(main.get_indicator_series("AAA", limit=limit))
+    assert raised.value.status_code == 400
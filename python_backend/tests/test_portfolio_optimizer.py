@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+from app.market_data import PriceStore
+from app.portfolio_optimizer import PortfolioOptimizer
+
+
+def make_store(n_assets=8, n_prices=400, seed=0):
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0005, 0.01, size=(n_prices - 1, n_assets)) * rng.uniform(0.5, 3.0, n_assets)
+    prices = 100.0 * np.vstack([np.ones(n_assets), np.cumprod(1.0 + returns, axis=0)])
+    store = PriceStore()
+    symbols = [f"S{i}" for i in range(n_assets)]
+    for column, symbol in enumerate(symbols):
+        store.add_prices(symbol, prices[:, column])
+    return store, symbols, rng
+
+
+def qp_objective(covariance, mean, risk_aversion, weights):
+    return 0.5 * risk_aversion * weights @ covariance @ weights - mean @ weights
+
+
+@pytest.mark.parametrize("risk_aversion, lower, upper", [
+    (1.0, 0.0, 1.0),
+    (5.0, 0.05, 0.3),
+    (50.0, 0.0, 0.2),
+    (0.5, 0.1, 0.15)
+])
+def test_active_set_matches_fista(risk_aversion, lower, upper):
+    store, symbols, _ = make_store()
+    optimizer = PortfolioOptimizer(store)
+    mean, covariance, _ = optimizer.get_covariance(symbols)
+
+    weights = optimizer._solve_qp(covariance, mean, risk_aversion, lower, upper)
+    reference = optimizer._accelerated_gradient(risk_aversion * covariance, mean, lower, upper)
+
+    assert weights.sum() == pytest.approx(1.0)
+    assert np.all(weights >= lower - 1e-9) and np.all(weights <= upper + 1e-9)
+    assert np.allclose(weights, reference, atol=1e-5)
+    assert (qp_objective(covariance, mean, risk_aversion, weights)
+            <= qp_objective(covariance, mean, risk_aversion, reference) + 1e-12)
+
+
+@pytest.mark.parametrize("lookback", [None, 50])
+def test_incremental_covariance_matches_recompute(lookback):
+    store, symbols, rng = make_store()
+    optimizer = PortfolioOptimizer(store)
+    optimizer.get_covariance(symbols, lookback)
+
+    for step in (1, 3, 10):
+        for symbol in symbols:
+            last = store.get_prices(symbol)[-1]
+            store.add_prices(symbol, last * np.cumprod(1.0 + rng.normal(0.0, 0.01, step)))
+        mean, covariance, shrinkage = optimizer.get_covariance(symbols, lookback)
+        fresh_mean, fresh_covariance, fresh_shrinkage = PortfolioOptimizer(store).get_covariance(symbols, lookback)
+
+        assert np.allclose(mean, fresh_mean, rtol=1e-9, atol=1e-12)
+        assert np.allclose(covariance, fresh_covariance, rtol=1e-9, atol=1e-14)
+        assert shrinkage == pytest.approx(fresh_shrinkage)
+
+
+def test_risk_parity_equalizes_risk_contributions():
+    store, symbols, _ = make_store()
+    result = PortfolioOptimizer(store).optimize(symbols, "risk_parity")
+
+    contributions = np.array(list(result["riskContributions"].values()))
+    assert np.allclose(contributions, contributions.mean(), rtol=1e-6)
+
+
+def test_risk_parity_respects_weight_bounds():
+    store, symbols, _ = make_store(n_assets=30)
+    optimizer = PortfolioOptimizer(store)
+    _, covariance, _ = optimizer.get_covariance(symbols)
+    lower, upper = 0.02, 0.05
+
+    weights = optimizer._risk_parity(covariance, None, lower, upper)
+    assert weights.sum() == pytest.approx(1.0)
+    assert np.all(weights >= lower - 1e-12) and np.all(weights <= upper + 1e-12)
+
+    # Unbound assets share one risk contribution; bound ones sit on the side the bound blocks
+    contributions = weights * (covariance @ weights)
+    free = (weights > lower + 1e-9) & (weights < upper - 1e-9)
+    level = contributions[free].mean()
+    assert free.any()
+    assert np.allclose(contributions[free], level, rtol=1e-6)
+    assert np.all(contributions[weights >= upper - 1e-9] <= level * (1 + 1e-9))
+    assert np.all(contributions[weights <= lower + 1e-9] >= level * (1 - 1e-9))
+
+
+def test_risk_parity_rejects_infeasible_bounds():
+    store, symbols, _ = make_store(n_assets=30)
+    with pytest.raises(ValueError):
+        PortfolioOptimizer(store).optimize(symbols, "risk_parity", max_weight=0.01)
+
+
+@pytest.mark.parametrize("method", ["mean_variance", "min_variance", "risk_parity"])
+def test_optimize_rejects_flat_prices(method):
+    store = PriceStore()
+    store.add_prices("A", [1.0] * 5)
+    store.add_prices("B", [2.0] * 5)
+    with pytest.raises(ValueError):
+        PortfolioOptimizer(store).optimize(["A", "B"], method)
+
+
+def test_optimize_request_rejects_null_fields():
+    import main
+
+    with pytest.raises(ValidationError):
+        main.PortfolioOptimizeRequest(symbols=["A", "B"], minWeight=None)
+    request = main.PortfolioOptimizeRequest(symbols=["A", "B"])
+    assert (request.riskAversion, request.minWeight, request.maxWeight) == (1.0, 0.0, 1.0)
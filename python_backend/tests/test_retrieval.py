@@ -0,0 +1,150 @@
+import math
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+from app.retrieval import MAX_SEARCH_RESULTS, SearchIndex, tokenize
+
+# A few very common words get dense tf rows; the long tail stays sparse
+COMMON = ["revenue", "growth", "margin", "cash"]
+VOCABULARY = [f"term{i}" for i in range(300)]
+
+
+def make_texts(count, seed=0):
+    rng = np.random.default_rng(seed)
+    texts = []
+    for _ in range(count):
+        words = list(rng.choice(COMMON, rng.integers(1, 6)))
+        words += list(rng.choice(VOCABULARY, rng.integers(3, 30), p=zipf_weights(len(VOCABULARY))))
+        rng.shuffle(words)
+        texts.append(" ".join(words))
+    return texts
+
+
+def zipf_weights(size):
+    weights = 1.0 / np.arange(1, size + 1)
+    return weights / weights.sum()
+
+
+def brute_force(records, query, k, session_id=None, k1=1.2, b=0.75):
+    """Score every passage with textbook BM25 over the whole collection"""
+    counts = [Counter(tokenize(record["text"])) for record in records]
+    lengths = [sum(count.values()) for count in counts]
+    average_length = sum(lengths) / len(records)
+    scores = []
+    terms = set(tokenize(query))
+    document_frequency = {term: sum(1 for count in counts if count[term]) for term in terms}
+    for passage_id, (record, count, length) in enumerate(zip(records, counts, lengths)):
+        if record["source"] == "chat" and record["ref"] != session_id:
+            continue
+        score = 0.0
+        for term in terms:
+            if count[term]:
+                df = document_frequency[term]
+                idf = math.log(1.0 + (len(records) - df + 0.5) / (df + 0.5))
+                score += idf * count[term] * (k1 + 1.0) / (count[term] + k1 * (1.0 - b + b * length / average_length))
+        if score > 0:
+            scores.append((score, passage_id))
+    scores.sort(reverse=True)
+    return scores[:k]
+
+
+def assert_matches_brute_force(index, records, query, k, session_id=None):
+    results = index.search(query, k=k, session_id=session_id)
+    ranking = brute_force(records, query, len(records), session_id)
+    expected = ranking[:k]
+    scores = {passage_id: score for score, passage_id in ranking}
+
+    assert len(results) == len(expected)
+    # Compare scores rather than ids, so ties may come back in either order
+    assert [result["score"] for result in results] == pytest.approx([score for score, _ in expected], rel=1e-5)
+    for result in results:
+        assert result["score"] == pytest.approx(scores[result["id"]], rel=1e-5)
+        assert result["text"] == records[result["id"]]["text"]
+
+
+QUERIES = ["revenue term0", "term5 term17 term150", "growth margin cash term2", "term299", "cash", "missing"]
+
+
+def test_search_matches_brute_force_across_segments_and_buffer(tmp_path):
+    index = SearchIndex(str(tmp_path), flush_threshold=64, merge_factor=2)
+    records = []
+    for batch, texts in enumerate(np.array_split(make_texts(700), 7)):
+        source, ref = ("chat", f"session{batch % 2}") if batch % 3 == 0 else ("filing", "")
+        ids = index.add_passages(list(texts), source, ref=ref)
+        assert ids == list(range(len(records), len(records) + len(texts)))
+        records.extend({"text": text, "source": source, "ref": ref} for text in texts)
+
+    # Searched while some passages are still buffered, then again once merged on disk
+    for flushed in (False, True):
+        if flushed:
+            index.flush()
+            assert index.stats()["buffered"] == 0
+        assert index.stats()["passages"] == len(records)
+        for query in QUERIES:
+            for k in (1, 5, MAX_SEARCH_RESULTS):
+                for session_id in (None, "session0", "session1"):
+                    assert_matches_brute_force(index, records, query, k, session_id)
+
+
+@pytest.mark.parametrize("flush", [False, True])
+def test_other_sessions_chat_does_not_crowd_out_filings(tmp_path, flush):
+    index = SearchIndex(str(tmp_path), flush_threshold=16, merge_factor=2)
+    filing_id = index.add_passage("Apple reported total net sales of 383 billion, with revenue down 3 percent.",
+                                  "filing", title="Apple 10-K")
+    for number in range(30):
+        index.add_passage("What was Apple revenue?", "chat", title="user", ref=f"session_{number}")
+    if flush:
+        index.flush()
+
+    results = index.search("Apple revenue", k=5, session_id="new_session")
+    assert [result["id"] for result in results] == [filing_id]
+
+    # A session sees its own message ahead of the filing, and nobody else's
+    results = index.search("Apple revenue", k=5, session_id="session_3")
+    assert [(result["source"], result["ref"]) for result in results] == [("chat", "session_3"), ("filing", "")]
+
+
+@pytest.mark.parametrize("k", [0, -1, MAX_SEARCH_RESULTS + 1])
+def test_search_rejects_k_out_of_range(tmp_path, k):
+    index = SearchIndex(str(tmp_path))
+    index.add_passage("revenue growth", "filing")
+    with pytest.raises(ValueError):
+        index.search("revenue", k=k)
+
+
+def test_write_ahead_log_survives_a_crash(tmp_path):
+    directory = str(tmp_path)
+    index = SearchIndex(directory, flush_threshold=100)
+    texts = make_texts(130)
+    index.add_passages(texts[:120], "filing")
+    # The first 100 passages reach a segment; the rest only exist in the log
+    index._writer.shutdown(wait=True)
+    index._log.close()
+    log_name = next(name for name in os.listdir(directory) if name.endswith(".log"))
+    with open(os.path.join(directory, log_name), "a", encoding="utf-8") as f:
+        f.write('{"text": "torn wri')
+
+    recovered = SearchIndex(directory, flush_threshold=100)
+    assert recovered.stats()["passages"] == 120
+    assert sorted(name for name in os.listdir(directory) if name.endswith(".log")) == ["buffer_000000000120.log"]
+    assert recovered.get_passage(119)["text"] == texts[119]
+
+    # Ids handed out before the crash are not reused
+    assert recovered.add_passages(texts[120:], "filing") == list(range(120, 130))
+    records = [{"text": text, "source": "filing", "ref": ""} for text in texts]
+    for query in QUERIES:
+        assert_matches_brute_force(recovered, records, query, 5)
+
+
+@pytest.mark.parametrize("field", ["title", "source", "ref"])
+def test_document_request_rejects_null_fields(field):
+    import main
+
+    with pytest.raises(ValidationError):
+        main.DocumentRequest(text="Apple revenue", **{field: None})
+    request = main.DocumentRequest(text="Apple revenue")
+    assert (request.title, request.source, request.ref) == ("", "filing", "")
@@ -0,0 +1,240 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from app.claude_client import ClaudeClient
+from app.tools import ToolRegistry
+from app.usage_ledger import DAILY_KEY_PREFIX, TokenBudgetExceeded, UsageLedger
+from test_claude_client import ECHO_TOOL, MODEL_ID, FakeRuntime, message, text_block, tool_block
+
+
+class FakeTable:
+    """In-memory stand-in for the DeepValueTokenUsage table"""
+
+    def __init__(self):
+        self.items = {}
+
+    def batch_writer(self):
+        table = self
+
+        class Batch:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def put_item(self, Item):
+                table.items[(Item["sessionId"], Item["usageId"])] = dict(Item)
+
+        return Batch()
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues):
+        item = self.items.setdefault((Key["sessionId"], Key["usageId"]), dict(Key))
+        for action in UpdateExpression[len("ADD "):].split(", "):
+            name, placeholder = action.split()
+            item[name] = item.get(name, 0) + ExpressionAttributeValues[placeholder]
+
+    def get_item(self, Key):
+        item = self.items.get((Key["sessionId"], Key["usageId"]))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def query(self, KeyConditionExpression, **kwargs):
+        session_id = KeyConditionExpression.get_expression()["values"][1]
+        return {"Items": [dict(item) for (key, _), item in sorted(self.items.items()) if key == session_id]}
+
+
+class FakeHistory:
+    """In-memory chat history service"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def get_session(self, session_id):
+        return None
+
+    async def create_session(self, session_id):
+        return session_id
+
+    async def get_messages(self, session_id):
+        return [message for message in self.messages if message["sessionId"] == session_id]
+
+    async def add_message(self, session_id, role, content):
+        self.messages.append({"sessionId": session_id, "role": role, "content": content})
+
+
+def make_ledger(table=None, **budgets):
+    ledger = UsageLedger(session_budget=budgets.get("session_budget", 0),
+                         global_daily_budget=budgets.get("global_daily_budget", 0))
+    ledger.table = table or FakeTable()
+    return ledger
+
+
+def make_client(ledger, streams):
+    async def echo(tool_input):
+        return "ok"
+
+    registry = ToolRegistry()
+    registry.register(ECHO_TOOL, echo, cacheable=False)
+    client = ClaudeClient(tool_registry=registry, usage_ledger=ledger)
+    client.bedrock_runtime = FakeRuntime(streams)
+    return client
+
+
+def stream(client, session_id):
+    async def collect():
+        return [chunk async for chunk in client.stream_message(
+            MODEL_ID, [{"role": "user", "content": "hi"}], session_id=session_id)]
+    return asyncio.run(collect())
+
+
+def test_stream_usage_from_message_start_and_delta():
+    ledger = make_ledger()
+    client = make_client(ledger, [
+        message(tool_block(0, "tool_1", "{}"), "tool_use", input_tokens=10, output_tokens=5),
+        message(text_block(0, "Done."), "end_turn", input_tokens=30, output_tokens=7)
+    ])
+    done = stream(client, "session1")[-1]
+
+    # message_delta carries the cumulative output count, replacing message_start's
+    assert done["type"] == "done"
+    assert done["usage"] == {"input_tokens": 40, "output_tokens": 12}
+    session = ledger.get_summary("session1")["session"]
+    assert (session["inputTokens"], session["outputTokens"], session["calls"], session["turns"]) == (40, 12, 2, 1)
+
+    asyncio.run(ledger.flush())
+    records = [item for (key, _), item in ledger.table.items.items() if key == "session1"]
+    assert sorted((item["round"], item["inputTokens"], item["outputTokens"]) for item in records) == [
+        (1, 10, 5), (2, 30, 7)
+    ]
+    assert {item["turnId"] for item in records} == {done["turnId"]}
+    daily = ledger.table.items[(f"{DAILY_KEY_PREFIX}{ledger.get_summary()['today']['date']}", "total")]
+    assert (daily["inputTokens"], daily["outputTokens"], daily["calls"], daily["turns"]) == (40, 12, 2, 1)
+
+
+def test_stream_usage_falls_back_to_invocation_metrics():
+    events = text_block(0, "Hi.") + [
+        {"type": "message_delta", "delta": {"stop_reason": "end_turn"}},
+        {"type": "message_stop", "amazon-bedrock-invocationMetrics": {"inputTokenCount": 12, "outputTokenCount": 3}}
+    ]
+    ledger = make_ledger()
+    done = stream(make_client(ledger, [events]), "session1")[-1]
+    assert done["usage"] == {"input_tokens": 12, "output_tokens": 3}
+
+
+def test_stream_usage_is_recorded_when_the_client_disconnects():
+    ledger = make_ledger(session_budget=100000)
+    client = make_client(ledger, [message(text_block(0, "Hello", " there."), "end_turn", input_tokens=900)])
+
+    async def disconnect():
+        chunks = client.stream_message(MODEL_ID, [{"role": "user", "content": "hi"}], session_id="session1")
+        assert (await chunks.__anext__())["type"] == "content"
+        await chunks.aclose()
+
+    asyncio.run(disconnect())
+    session = ledger.get_summary("session1")["session"]
+    assert (session["inputTokens"], session["outputTokens"], session["calls"]) == (900, 1, 1)
+    assert ledger.get_summary()["today"]["reserved"] == 0
+
+
+def test_stream_usage_is_recorded_when_the_stream_fails():
+    class FailingRuntime(FakeRuntime):
+        def invoke_model_with_response_stream(self, **params):
+            events = super().invoke_model_with_response_stream(**params)["body"]
+
+            def body():
+                yield from events[:3]
+                raise ConnectionError("stream reset")
+            return {"body": body()}
+
+    ledger = make_ledger()
+    client = make_client(ledger, [])
+    client.bedrock_runtime = FailingRuntime([message(text_block(0, "Hello"), "end_turn", input_tokens=700)])
+
+    chunks = stream(client, "session1")
+    assert chunks[-1] == {"type": "error", "error": "stream reset"}
+    assert ledger.get_summary("session1")["session"]["inputTokens"] == 700
+    assert ledger.get_summary()["today"]["reserved"] == 0
+
+
+def test_reservations_hold_budget_until_settled():
+    ledger = make_ledger(session_budget=3000)
+
+    async def run():
+        reservations = []
+        for _ in range(5):
+            try:
+                reservations.append(await ledger.reserve("session1", 500, 2000))
+            except TokenBudgetExceeded:
+                pass
+        return reservations
+
+    reservations = asyncio.run(run())
+    assert [reservation["tokens"] for reservation in reservations] == [2500]
+    assert reservations[0]["maxTokens"] == 2000
+
+    # Settling with the actual usage frees the rest of the reservation
+    asyncio.run(ledger.record("session1", MODEL_ID, {"input_tokens": 400, "output_tokens": 100}, reservations[0]))
+    reservation = asyncio.run(ledger.reserve("session1", 500, 4096))
+    assert reservation["maxTokens"] == 3000 - 500 - 500
+    ledger.release(reservation)
+    ledger.release(reservation)
+    assert ledger.get_summary()["today"]["reserved"] == 0
+
+
+def test_daily_total_survives_restart():
+    table = FakeTable()
+    ledger = make_ledger(table, global_daily_budget=1000)
+    asyncio.run(ledger.record("session1", MODEL_ID, {"input_tokens": 600, "output_tokens": 200}))
+    asyncio.run(ledger.flush())
+
+    restarted = make_ledger(table, global_daily_budget=1000)
+    with pytest.raises(TokenBudgetExceeded):
+        asyncio.run(restarted.reserve("session2", 100, 4096))
+    assert restarted.get_summary()["today"]["tokens"] == 800
+
+
+@pytest.fixture
+def exhausted_main(monkeypatch):
+    """main with a session budget too small for any call, and no AWS behind it"""
+    import main
+
+    runtime = FakeRuntime([message(text_block(0, "unused"), "end_turn")])
+    history = FakeHistory()
+    monkeypatch.setattr(main, "chat_history_service", history)
+    monkeypatch.setattr(main.usage_ledger, "table", FakeTable())
+    monkeypatch.setattr(main.usage_ledger, "session_budget", 100)
+    monkeypatch.setattr(main.claude_client, "bedrock_runtime", runtime)
+    return main, runtime, history
+
+
+def test_chat_returns_429_when_budget_is_exhausted(exhausted_main):
+    main, runtime, history = exhausted_main
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(main.chat(main.ChatRequest(message="Apple budget question", sessionId="budget-session")))
+    assert raised.value.status_code == 429
+    assert "session" in raised.value.detail
+    assert runtime.bodies == []
+    assert main.usage_ledger.get_summary()["today"]["reserved"] == 0
+
+    # The refused message is neither stored nor indexed, so it is not re-sent next time
+    assert history.messages == []
+    assert main.search_index.search("Apple budget question", session_id="budget-session") == []
+
+
+def test_stream_refuses_message_when_budget_is_exhausted(exhausted_main):
+    main, runtime, history = exhausted_main
+
+    async def collect():
+        response = await main.stream_chat("Apple stream budget question", sessionId="stream-session")
+        return [json.loads(event["data"]) async for event in response.body_iterator]
+
+    events = asyncio.run(collect())
+    assert events[-1]["type"] == "error"
+    assert "session" in events[-1]["error"]
+    assert runtime.bodies == []
+    assert history.messages == []
+    assert main.search_index.search("Apple stream budget question", session_id="stream-session") == []